@@ -0,0 +1,159 @@
+"""
+    Atlas -- packing of many graphics into a few large images.
+"""
+
+import os, json
+from omg.util import *
+from omg.lump import Graphic
+
+try:
+    from PIL import Image
+except:
+    pass
+
+class Skyline:
+    """A skyline bin packer for a single rectangular page.
+
+    The skyline is kept as a list of [x, y, width] segments covering
+    the page from left to right; each rectangle is placed at the
+    lowest position available (ties broken by the narrowest fit)."""
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.nodes = [[0, 0, width]]
+
+    def _fit(self, i, width, height):
+        """Return the y position where a rectangle would rest if placed
+        at the start of segment i, or None if it doesn't fit there."""
+        x = self.nodes[i][0]
+        if x + width > self.width:
+            return None
+        y = 0
+        remaining = width
+        while remaining > 0:
+            y = max(y, self.nodes[i][1])
+            if y + height > self.height:
+                return None
+            remaining -= self.nodes[i][2]
+            i += 1
+        return y
+
+    def insert(self, width, height):
+        """Place a rectangle. Returns its (x, y) position, or None if
+        the page has no room left for it."""
+        best = None
+        for i in range(len(self.nodes)):
+            y = self._fit(i, width, height)
+            if y is None:
+                continue
+            score = (y + height, self.nodes[i][2])
+            if best is None or score < best[0]:
+                best = (score, i, y)
+        if best is None:
+            return None
+
+        score, i, y = best
+        x = self.nodes[i][0]
+        self.nodes.insert(i, [x, y + height, width])
+        # shrink or remove the segments now covered by the new one
+        i += 1
+        while i < len(self.nodes):
+            node = self.nodes[i]
+            prev = self.nodes[i-1]
+            overlap = prev[0] + prev[2] - node[0]
+            if overlap <= 0:
+                break
+            node[0] += overlap
+            node[2] -= overlap
+            if node[2] > 0:
+                break
+            del self.nodes[i]
+        # merge neighbouring segments of the same height
+        i = 0
+        while i < len(self.nodes) - 1:
+            if self.nodes[i][1] == self.nodes[i+1][1]:
+                self.nodes[i][2] += self.nodes[i+1][2]
+                del self.nodes[i+1]
+            else:
+                i += 1
+        return x, y
+
+
+class Atlas:
+    """Packs the graphics of a lump group (sprites, patches, flats...)
+    into one or more atlas pages.
+
+    Data members:
+        .pages     List of PIL Image instances, one per page
+        .index     OrderedDict mapping lump names to dicts with the keys
+                   'page', 'x', 'y', 'width', 'height', 'x_offset',
+                   'y_offset' and the normalized texture coordinates
+                   'u0', 'v0', 'u1', 'v1'
+    """
+
+    def __init__(self, group=None, size=(1024, 1024), padding=1, mode='RGBA'):
+        """Create a new atlas, optionally packing a group of graphics
+        right away. `size` is the size of each page and `padding` the
+        number of empty pixels kept between graphics. `mode` is the
+        PIL image mode used for the pages."""
+        self.size = size
+        self.padding = padding
+        self.mode = mode
+        self.pages = []
+        self.index = OrderedDict()
+        self._packers = []
+        if group is not None:
+            self.add_group(group)
+
+    def add_group(self, group):
+        """Decode and pack all graphics in a group (or any dict-like
+        object containing Graphic lumps)."""
+        headers = Graphic.headers(group)
+        # packing the tallest graphics first gives the flattest skyline
+        names = sorted(headers, key=lambda n: (-headers[n][1], -headers[n][0]))
+        for name in names:
+            self.add(name, group[name], headers[name])
+
+    def add(self, name, graphic, header=None):
+        """Decode and pack a single graphic."""
+        width, height, x_offset, y_offset = header or Graphic.headers({name: graphic})[name]
+        pw, ph = self.size
+        if width + self.padding > pw or height + self.padding > ph:
+            raise ValueError("%s (%dx%d) does not fit on an atlas page" % (name, width, height))
+
+        for page, packer in enumerate(self._packers):
+            pos = packer.insert(width + self.padding, height + self.padding)
+            if pos is not None:
+                break
+        else:
+            page = len(self._packers)
+            self._packers.append(Skyline(pw, ph))
+            self.pages.append(Image.new(self.mode, self.size, None))
+            pos = self._packers[page].insert(width + self.padding, height + self.padding)
+
+        x, y = pos
+        self.pages[page].paste(graphic.to_Image(self.mode), (x, y))
+        self.index[name] = {
+            'page': page, 'x': x, 'y': y, 'width': width, 'height': height,
+            'x_offset': x_offset, 'y_offset': y_offset,
+            'u0': x / pw, 'v0': y / ph,
+            'u1': (x + width) / pw, 'v1': (y + height) / ph
+        }
+
+    def to_json(self, pagenames=None):
+        """Return the atlas index as a JSON string. `pagenames` may be
+        a list of file names to record for the pages."""
+        return json.dumps({'size': list(self.size), 'pages': pagenames or [],
+            'frames': self.index}, indent=1)
+
+    def to_files(self, basename, format='png'):
+        """Save the pages as <basename>_<n>.<format> and the index as
+        <basename>.json."""
+        pagenames = []
+        for n, page in enumerate(self.pages):
+            filename = "%s_%d.%s" % (basename, n, format)
+            page.save(filename)
+            pagenames.append(os.path.basename(filename))
+        with open(basename + ".json", 'w') as f:
+            f.write(self.to_json(pagenames))
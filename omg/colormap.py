@@ -1,61 +1,230 @@
+import os
 import omg.palette
 import omg.lump
+from omg.util import *
+
+# NumPy is optional; it only speeds up blending colors for translucency tables.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# PIL is only needed for rendering graphics (see Colormap.render).
+try:
+    from PIL import Image
+except:
+    pass
+
+def _to_Image(pixels, mask, size, palette, mode):
+    """Convert palette indices and a transparency mask (as returned by
+    Graphic.decode) to a PIL Image instance. Transparent pixels must
+    hold the palette's transparent index."""
+    if mode == 'RGBA':
+        rgba = omg.lump.rgba_from_indices(pixels, mask, palette)
+        return Image.frombytes('RGBA', size, rgba)
+    im = Image.frombytes('P', size, bytes(pixels))
+    im.putpalette(palette.save_bytes)
+    if mode != 'P':
+        im = im.convert(mode)
+    return im
+
+class Tables:
+    """List-like access to the tables of a colormap. Indexing returns
+    a table as a (zero-copy) memoryview of the colormap's data, and
+    assigning any sequence of 256 indices to a table copies it in."""
+
+    def __init__(self, data):
+        self.view = memoryview(data)
+
+    def __len__(self):
+        return len(self.view) // 256
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self[i] for i in range(*n.indices(len(self)))]
+        if n < 0:
+            n += len(self)
+        if not 0 <= n < len(self):
+            raise IndexError("table index out of range")
+        return self.view[n*256:(n+1)*256]
+
+    def __setitem__(self, n, table):
+        self[n][:] = bytes(table)
+
+    def __iter__(self):
+        for n in range(len(self)):
+            yield self[n]
 
 class Colormap:
     """An editor for Doom's COLORMAP lump. The colormap holds 34 tables
     of indices to the game's palette. The first 32 tables hold data
     for different brightness levels, the 33rd holds the indices used
-    by the invulnerability powerup, and the 34th is unused."""
+    by the invulnerability powerup, and the 34th is unused.
+
+    The tables are stored together in .data, a bytearray of 34*256
+    bytes; .tables gives access to them one at a time (see Tables)."""
 
     def __init__(self, from_lump=None):
         """Create new, optionally from an existing lump."""
-        self.tables = [[0 for x in range(256)] for y in range(34)]
+        self.data = bytearray(34*256)
+        self.tables = Tables(self.data)
         if from_lump:
             self.from_lump(from_lump)
 
-    def build_fade(self, palette=None, fade=(0,0,0)):
-        """Build fade tables. The default fade color is black;
-        this may be overriden. Light color is not yet supported."""
+    def build_fade(self, palette=None, fade=(0,0,0), light=(255,255,255)):
+        """Build fade tables. The default fade (fog) color is black and
+        the default light color is white; both may be overriden. Colors
+        are first tinted by the light color, then faded to the fog color
+        over the 32 light levels."""
         palette = palette or omg.palette.default
         x, y, z = fade
-        for n in range(32):
-            e = 31-n
-            for c in range(256):
-                r, g, b = palette.colors[c]
-                r = (r*n + x*e) // 32
-                g = (g*n + y*e) // 32
-                b = (b*n + z*e) // 32
-                self.tables[e][c] = palette.match((r,g,b))
+        lr, lg, lb = light
+        tinted = [(r*lr // 255, g*lg // 255, b*lb // 255) for r, g, b in palette.colors]
+        colors = [((r*n + x*e) // 32, (g*n + y*e) // 32, (b*n + z*e) // 32) \
+            for e, n in [(e, 31-e) for e in range(32)] for r, g, b in tinted]
+        self.data[:32*256] = palette.match_many(colors)
 
     def build_invuln(self, palette=None, start=(0,0,0), end=(255,255,255)):
         """Build range used by the invulnerability powerup."""
         palette = palette or omg.palette.default
         ar, ag, ab = start
         br, bg, bb = end
+        colors = []
         for i in range(256):
             bright = sum(palette.colors[i]) // 3
             r = (ar*bright + br*(256-bright)) // 256
             g = (ag*bright + bg*(256-bright)) // 256
             b = (ab*bright + bb*(256-bright)) // 256
-            self.tables[32][i] = palette.match((r,g,b))
+            colors.append((r,g,b))
+        self.tables[32] = palette.match_many(colors)
 
     def from_lump(self, lump):
         """Load from a COLORMAP lump."""
         assert len(lump.data) == 34*256
-        for n in range(34):
-            self.tables[n] = [lump.data[i] for i in range(n*256,(n+1)*256)]
+        self.data[:] = lump.data
 
     def to_lump(self):
         """Pack to a COLORMAP lump."""
-        output = bytes()
-        for t in self.tables:
-            output += bytes(t)
-        return omg.lump.Lump(output)
+        return omg.lump.Lump(bytes(self.data))
+
+    def apply(self, pixels, table=0):
+        """Return a bytes-like object of palette indices (such as the
+        output of Graphic.to_raw) translated through one of the tables,
+        e.g. to darken an image to one of the light levels."""
+        return pixels.translate(self.tables[table])
+
+    def render(self, graphic, levels=None, mode='RGBA', strip=False):
+        """Render a Graphic (or Flat) through some of the tables, e.g.
+        to preview it at different light levels. 'levels' is a list of
+        table numbers, all 32 light levels by default.
 
-        # packed = [''.join([chr(c) for c in t]) for t in self.tables]
-        # return omg.lump.Lump(''.join(packed))
+        Returns a list of PIL Image instances (in the given mode), one
+        per table, or if 'strip' is true, a single image with all of
+        them side by side. The graphic is decoded once, and each image
+        is expanded from palette indices to colors in one pass."""
+        if levels is None:
+            levels = range(32)
+        width, height = graphic.dimensions
+        palette = graphic.palette
+        tables = [bytes(self.tables[n]) for n in levels]
+        if isinstance(graphic, omg.lump.Flat):
+            pixels = bytes(graphic.data)
+            mask = b'\xff' * len(pixels)
+        else:
+            pixels, mask = graphic.decode(palette.tran_index)
+            # keep the transparent index at transparent pixels
+            tran = palette.tran_index
+            tables = [table[:tran] + bytes([tran]) + table[tran+1:] for table in tables]
+        shaded = [pixels.translate(table) for table in tables]
+
+        if strip and shaded:
+            row = width * len(shaded)
+            strip_pixels = bytearray(row * height)
+            strip_mask = bytearray(row * height)
+            for y in range(height):
+                line = slice(y*width, (y+1)*width)
+                for i, level in enumerate(shaded):
+                    start = y*row + i*width
+                    strip_pixels[start:start+width] = level[line]
+                    strip_mask[start:start+width] = mask[line]
+            return _to_Image(strip_pixels, strip_mask, (row, height), palette, mode)
+        return [_to_Image(level, mask, (width, height), palette, mode) \
+            for level in shaded]
+
+    def render_group(self, group, levels=None, mode='RGBA', strip=True):
+        """Render all graphics in a group (or any dict-like object
+        containing Graphic lumps) through some of the tables. Returns an
+        OrderedDict mapping names to the results of render (light-ramp
+        strips by default)."""
+        return OrderedDict([(name, self.render(group[name], levels, mode, strip)) \
+            for name in group.keys()])
 
     def set_position(self,table,index,pal_index):
         """Sets a specified position in the colormap to the specified
         index in the playpal."""
         self.tables[table][index] = pal_index
+
+
+class Tranmap:
+    """An editor for Boom's TRANMAP lump. The translucency map holds
+    256 tables of 256 palette indices; the color at [bg][fg] is the
+    result of drawing color fg translucently over color bg. .data is a
+    bytearray of 256*256 bytes holding the tables, and .tables gives
+    access to them one at a time (see Tables)."""
+
+    def __init__(self, from_lump=None):
+        """Create new, optionally from an existing lump."""
+        self.data = bytearray(256*256)
+        self.tables = Tables(self.data)
+        if from_lump:
+            self.from_lump(from_lump)
+
+    def build(self, palette=None, alpha=0.66, mode='alpha', cache_dir=None):
+        """Build the tables. 'alpha' is the weight (0-1) of the color
+        being drawn. With mode 'alpha', it is blended with the color
+        below (Boom's default is an opacity of 66%); with mode
+        'additive', the weighted color is added to the color below.
+
+        All 65536 blended colors are matched at once (see
+        Palette.match_many). If 'cache_dir' is given, the tables are
+        saved there and loaded again if tables were already built for
+        the same palette colors, lookup settings, alpha and mode."""
+        assert 0.0 <= alpha <= 1.0
+        if mode not in ('alpha', 'additive'):
+            raise ValueError("mode must be 'alpha' or 'additive'")
+        palette = palette or omg.palette.default
+        weight = int(alpha*256 + 0.5)
+        path = None
+        if cache_dir:
+            path = os.path.join(cache_dir, "tranmap-%s-%s-%d.lmp" % \
+                (palette.memo_key().hex(), mode, weight))
+            if os.path.exists(path):
+                self.data[:] = readfile(path)
+                return
+
+        if np is not None:
+            pal = np.array(palette.colors, dtype=np.int32)
+            bg, fg = pal[:,None,:], pal[None,:,:]*weight
+            if mode == 'alpha':
+                colors = (bg*(256 - weight) + fg) >> 8
+            else:
+                colors = np.minimum(bg + (fg >> 8), 255)
+            colors = colors.reshape(-1, 3)
+        elif mode == 'alpha':
+            colors = [tuple((b*(256 - weight) + f*weight) >> 8 for b, f in zip(bg, fg)) \
+                for bg in palette.colors for fg in palette.colors]
+        else:
+            colors = [tuple(min(b + ((f*weight) >> 8), 255) for b, f in zip(bg, fg)) \
+                for bg in palette.colors for fg in palette.colors]
+        self.data[:] = palette.match_many(colors)
+        if path:
+            writefile(path, self.data)
+
+    def from_lump(self, lump):
+        """Load from a TRANMAP lump."""
+        assert len(lump.data) == 256*256
+        self.data[:] = lump.data
+
+    def to_lump(self):
+        """Pack to a TRANMAP lump."""
+        return omg.lump.Lump(bytes(self.data))
@@ -15,6 +15,12 @@ try:
 except:
     pass
 
+# NumPy is optional; it speeds up decoding graphics.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 import os
 import omg.palette
 from omg.util import *
@@ -346,6 +352,32 @@ class Sound(Lump):
             raise TypeError("audio file export only supported for digitized sounds (format 3)")
 
 
+def rgba_from_indices(pixels, mask, palette):
+    """Expand 8-bit pixels and a transparency mask (as returned by
+    Graphic.decode) to 32-bit RGBA pixels using a Palette. Transparent
+    pixels are black with zero alpha."""
+    if np is not None:
+        # look up whole RGBA pixels (as 32-bit integers) at once
+        table = np.full((256, 4), 0xff, dtype=np.uint8)
+        table[:, :3] = np.frombuffer(palette.bytes, dtype=np.uint8).reshape(256, 3)
+        rgba = table.view('<u4').ravel()[np.frombuffer(pixels, dtype=np.uint8)]
+        rgba[np.frombuffer(mask, dtype=np.uint8) == 0] = 0
+        return rgba.tobytes()
+    red, green, blue = palette.channels()
+    rgba = bytearray(len(pixels)*4)
+    rgba[0::4] = pixels.translate(red)
+    rgba[1::4] = pixels.translate(green)
+    rgba[2::4] = pixels.translate(blue)
+    rgba[3::4] = mask
+    # clear the color of transparent pixels
+    opaque = bytearray(len(rgba))
+    for i in range(4):
+        opaque[i::4] = mask
+    size = len(rgba)
+    rgba = int.from_bytes(rgba, 'little') & int.from_bytes(opaque, 'little')
+    return rgba.to_bytes(size, 'little')
+
+
 class Graphic(Lump):
     """Subclass of Lump, for Doom format graphics. Supports
     conversion from/to RAWs (sequences of bytes) and PIL
@@ -364,31 +396,85 @@ class Graphic(Lump):
         self.palette = palette or omg.palette.default
         Lump.__init__(self, data, from_file)
 
+    def get_data(self):
+        return self._data
+
+    def set_data(self, data):
+        # The header and column pointers are parsed on demand and
+        # cached until the data is replaced.
+        self._data = data
+        self._header = None
+        self._pointers = None
+
+    data = property(get_data, set_data)
+
+    def get_header(self):
+        """Retrieve the (width, height, x_offset, y_offset) header
+        of the graphic."""
+        if self._header is None:
+            self._header = unpack('<hhhh', self._data[0:8])
+        return self._header
+
+    def get_pointers(self):
+        """Retrieve the column pointers of the graphic."""
+        if self._pointers is None:
+            width = self.get_header()[0]
+            self._pointers = unpack('<%il'%width, self._data[8 : 8 + width*4])
+        return self._pointers
+
     def get_offsets(self):
         """Retrieve the (x, y) offsets of the graphic."""
-        return unpack('<hh', self.data[4:8])
+        return self.get_header()[2:4]
 
     def set_offsets(self, xy):
         """Set the (x, y) offsets of the graphic."""
-        self.data = self.data[:4] + pack('<hh', *xy) + self.data[8:]
+        header = self.get_header()[0:2] + tuple(xy)
+        pointers = self._pointers
+        self.data = self._data[:4] + pack('<hh', *xy) + self._data[8:]
+        self._header = header
+        self._pointers = pointers
 
     def get_dimensions(self):
         """Retrieve the (width, height) dimensions of the graphic."""
-        return unpack('<hh', self.data[0:4])
+        return self.get_header()[0:2]
+
+    @staticmethod
+    def headers(group):
+        """Retrieve the headers of all graphics in a lump group (or any
+        other dict-like object containing Graphic lumps) in one pass.
+
+        Returns an OrderedDict mapping lump names to
+        (width, height, x_offset, y_offset) tuples. Flats are reported
+        with zero offsets."""
+        output = OrderedDict()
+        for name, lump in group.items():
+            if isinstance(lump, Flat):
+                output[name] = lump.dimensions + (0, 0)
+            elif isinstance(lump, Graphic):
+                output[name] = lump.get_header()
+            else:
+                output[name] = unpack('<hhhh', lump.data[0:8])
+        return output
 
     offsets = property(get_offsets, set_offsets)
-    x_offset = property(lambda self: self.offsets[0],
-        lambda self, x: self.set_offsets((x, self.y_offset)))
-    y_offset = property(lambda self: self.offsets[1],
-        lambda self, y: self.set_offsets((self.x_offset, y)))
+    x_offset = property(lambda self: self.get_header()[2],
+        lambda self, x: self.set_offsets((x, self.get_header()[3])))
+    y_offset = property(lambda self: self.get_header()[3],
+        lambda self, y: self.set_offsets((self.get_header()[2], y)))
 
     dimensions = property(get_dimensions)
     width  = property(lambda self: self.dimensions[0])
     height = property(lambda self: self.dimensions[1])
 
-    def from_pixels(self, data, width, height, x_offset=0, y_offset=0):
+    def from_pixels(self, data, width, height, x_offset=0, y_offset=0, dedupe=False):
         """Load a list of 8bpp pixels.
-        Pixels with value None are transparent."""
+        Pixels with value None are transparent.
+
+        If `dedupe` is true, identical columns (e.g. solid borders,
+        repeating patterns or fully transparent columns) are stored
+        only once and share a single column pointer.
+
+        Returns the number of bytes saved by column deduplication."""
         if min(width, height) < 0 or max(width, height) > 32767:
             raise ValueError("image width and height must be between 0-32767")
 
@@ -437,52 +523,126 @@ class Graphic(Lump):
         data = []
         columnptrs = []
         pointer = 4*width + 8
+        saved = 0
+        seen = {}
         for column in columns_out:
+            body = bytes().join([b"%c%c\x00%s\x00" % (row, len(pixels), pixels) \
+                for row, pixels in column]) + b'\xff'
+            if dedupe and body in seen:
+                # reuse the body of an identical column
+                columnptrs.append(pack('<i', seen[body]))
+                saved += len(body)
+                continue
+            seen[body] = pointer
             columnptrs.append(pack('<i', pointer))
-            for row, pixels in column:
-                data.append(b"%c%c\x00%s\x00" % (row, len(pixels), pixels))
-                pointer += 4 + len(pixels)
-            data.append(b'\xff')
-            pointer += 1
+            data.append(body)
+            pointer += len(body)
         # Merge everything together
         self.data = bytes().join([pack('4h', width, height, x_offset, y_offset),
                     bytes().join(columnptrs), bytes().join(data)])
+        return saved
 
-    def from_raw(self, data, width, height, x_offset=0, y_offset=0, pal=None):
+    def from_raw(self, data, width, height, x_offset=0, y_offset=0, pal=None, dedupe=False):
         """Load a raw 8-bpp image, converting to the Doom picture format
-        (used by all graphics except flats)."""
+        (used by all graphics except flats).
+
+        See from_pixels for the meaning of `dedupe` and the return value."""
         pal = pal or omg.palette.default
         pixels = [i if i != pal.tran_index else None for i in data]
-        self.from_pixels(pixels, width, height, x_offset, y_offset)
+        return self.from_pixels(pixels, width, height, x_offset, y_offset, dedupe)
 
-    def to_pixels(self):
-        """Returns self converted to a list of 8bpp pixels.
-        Pixels with value None are transparent."""
+    def get_posts(self):
+        """Returns the columns of the graphic as lists of (y, pixels)
+        posts, with the pixels as bytes. Posts are clipped to the height
+        of the graphic."""
         data = self.data
-        width, height = self.dimensions
-        output = [None] * (width*height)
-        pointers = unpack('<%il'%width, data[8 : 8 + width*4])
-        for x in range(width):
+        height = self.dimensions[1]
+        columns = []
+        for pointer in self.get_pointers():
+            posts = []
             y = -1
-            pointer = pointers[x]
-            if pointer >= len(data):
-                continue
-
-            while data[pointer] != 0xff:
+            while pointer < len(data) and data[pointer] != 0xff:
                 offset = data[pointer]
                 if offset <= y:
                     y += offset # for tall patches
                 else:
                     y = offset
                 post_length = data[pointer + 1]
-                op = y*width + x
-                for p in range(pointer + 3, pointer + post_length + 3):
-                    if op >= len(output) or p >= len(data):
-                        break
-                    output[op] = data[p]
-                    op += width
+                pixels = data[pointer + 3 : pointer + 3 + post_length]
+                if y + len(pixels) > height:
+                    # clip posts to the height of the graphic
+                    pixels = pixels[:max(0, height - y)]
+                posts.append((y, pixels))
                 pointer += post_length + 4
-        return output
+            columns.append(posts)
+        return columns
+
+    def decode(self, tran_index=0):
+        """Returns self converted to a raw (8-bpp) image and a
+        transparency mask, as a tuple of two bytearrays. In the mask,
+        opaque pixels are 0xff and transparent pixels are 0. Transparent
+        pixels in the image are set to `tran_index`."""
+        if np is not None:
+            return self._decode_array(tran_index)
+        width, height = self.dimensions
+        output = bytearray([tran_index]) * (width*height)
+        mask = bytearray(width*height)
+        opaque = b'\xff' * 256
+        for x, posts in enumerate(self.get_posts()):
+            for y, pixels in posts:
+                start = y*width + x
+                stop = start + len(pixels)*width
+                output[start : stop : width] = pixels
+                mask[start : stop : width] = opaque[:len(pixels)]
+        return output, mask
+
+    def _decode_array(self, tran_index):
+        # decode with NumPy: the posts of all columns are walked at the
+        # same time (one step per post), and then all pixels are copied
+        # with a single fancy indexing assignment
+        width, height = self.dimensions
+        size = len(self.data)
+        # padding, so that reading a post header never goes out of range
+        data = np.frombuffer(self.data + bytes(4), dtype=np.uint8)
+        pointers = np.array(self.get_pointers(), dtype=np.int64)
+        columns = np.arange(width)
+        ys = np.full(width, -1, dtype=np.int64)
+        found = []
+        active = (pointers >= 0) & (pointers < size)
+        active[active] = data[pointers[active]] != 0xff
+        while active.any():
+            x = columns[active]
+            pointer = pointers[x]
+            offset = data[pointer].astype(np.int64)
+            length = data[pointer + 1].astype(np.int64)
+            y = np.where(offset <= ys[x], ys[x] + offset, offset) # for tall patches
+            ys[x] = y
+            # clip posts to the end of the data and the height of the graphic
+            count = np.clip(np.minimum(length, size - pointer - 3), 0, None)
+            count = np.clip(np.minimum(count, height - y), 0, None)
+            found.append((x, y, pointer + 3, count))
+            pointers[x] = pointer + length + 4
+            active[x] = pointers[x] < size
+            active[active] = data[pointers[active]] != 0xff
+
+        output = np.full(width*height, tran_index, dtype=np.uint8)
+        mask = np.zeros(width*height, dtype=np.uint8)
+        if found:
+            x, y, start, count = [np.concatenate(a) for a in zip(*found)]
+            total = int(count.sum())
+            first = np.cumsum(count) - count
+            step = np.arange(total) - np.repeat(first, count)
+            source = np.repeat(start, count) + step
+            target = np.repeat(y*width + x, count) + step*width
+            output[target] = data[source]
+            mask[target] = 0xff
+        return bytearray(output.tobytes()), bytearray(mask.tobytes())
+
+    def to_pixels(self):
+        """Returns self converted to a list of 8bpp pixels.
+        Pixels with value None are transparent."""
+        output, mask = self.decode()
+        return [i if m else None for i, m in zip(output, mask)]
 
     def to_raw(self, tran_index=None):
         """Returns self converted to a raw (8-bpp) image.
@@ -492,8 +652,13 @@ class Graphic(Lump):
         Graphic object's palette instance.
         """
         tran_index = tran_index or self.palette.tran_index
-        output = [i if i is not None else tran_index for i in self.to_pixels()]
-        return bytes(bytearray(output))
+        return bytes(self.decode(tran_index)[0])
+
+    def to_rgba(self):
+        """Returns self converted to 32-bit RGBA pixels. Transparent
+        pixels are black with zero alpha."""
+        output, mask = self.decode()
+        return rgba_from_indices(output, mask, self.palette)
 
     def to_Image(self, mode='P'):
         """Convert to a PIL Image instance."""
@@ -510,35 +675,53 @@ class Graphic(Lump):
         else:
             # target image is RGBA and source image is not a flat
             im = Image.new('RGBA', self.dimensions, None)
-            data = bytes().join([self.palette.bytes[i*3:i*3+3] + b'\xff' if i is not None \
-                                 else b'\0\0\0\0' for i in self.to_pixels()])
-            im.frombytes(data)
+            im.frombytes(self.to_rgba())
             return im
 
-    def from_Image(self, im, translate=False):
+    def from_Image(self, im, translate=False, dedupe=False, dither=None):
         """Load from a PIL Image instance.
 
         If the input image is 24-bit or 32-bit, the colors will be
-        looked up in the current palette.
+        looked up in the current palette. To dither them, set `dither`
+        to 'ordered' or 'floyd-steinberg' (see Palette.dither).
 
         If the input image is 8-bit, indices will simply be copied
         from the input image. To properly translate colors between
         palettes, set the `translate` parameter.
+
+        See from_pixels for the meaning of `dedupe` and the return value.
         """
         pixels = im.tobytes()
         width, height = im.size
         xoff, yoff = (width // 2)-1, height-5
         if im.mode == "RGB":
-            pixels = bytes([self.palette.match(unpack('BBB', \
-                pixels[i*3:(i+1)*3])) for i in range(width*height)])
+            if dither:
+                pixels = self.palette.dither(pixels, width, dither)
+            else:
+                pixels = self.palette.match_many(pixels)
 
-            self.from_raw(pixels, width, height, xoff, yoff, self.palette)
+            return self.from_raw(pixels, width, height, xoff, yoff, self.palette, dedupe)
 
         elif im.mode == "RGBA":
-            pixels = [unpack('BBBB', pixels[i*4:(i+1)*4]) for i in range(width*height)]
-            pixels = [self.palette.match(i[0:3]) if i[3] > 0 else None for i in pixels]
+            colors = bytearray(width*height*3)
+            for i in range(3):
+                colors[i::3] = pixels[i::4]
+            if dither:
+                # Replace the colors of fully transparent pixels by the
+                # transparency color, which dithering leaves alone, so
+                # they don't spread their error to visible pixels.
+                alpha = pixels[3::4]
+                tran = bytes(self.palette.tran_color)
+                i = alpha.find(0)
+                while i != -1:
+                    colors[i*3:i*3+3] = tran
+                    i = alpha.find(0, i+1)
+                colors = self.palette.dither(colors, width, dither)
+            else:
+                colors = self.palette.match_many(colors)
+            pixels = [c if a > 0 else None for c, a in zip(colors, pixels[3::4])]
 
-            self.from_pixels(pixels, width, height, xoff, yoff)
+            return self.from_pixels(pixels, width, height, xoff, yoff, dedupe)
 
         elif im.mode == 'P':
             srcpal = im.palette.tobytes()
@@ -554,9 +737,8 @@ class Graphic(Lump):
                 G = [c for c in srcpal[1::palsize]]
                 B = [c for c in srcpal[2::palsize]]
 
-                srcpal = zip(R, G, B)
-                lexicon = [self.palette.match(c) for c in srcpal]
-                pixels = bytes([lexicon[b] for b in pixels])
+                lexicon = self.palette.match_many(list(zip(R, G, B)))
+                pixels = pixels.translate(lexicon + bytes(256 - len(lexicon)))
             else:
                 # Simply copy pixels. However, make sure to translate
                 # all colors matching the transparency color to the
@@ -571,17 +753,20 @@ class Graphic(Lump):
                     if not ri % palsize and ri//palsize != self.palette.tran_index:
                         pixels = pixels.replace(pack("B", ri//palsize), packed_index)
 
-            self.from_raw(pixels, width, height, xoff, yoff, self.palette)
+            return self.from_raw(pixels, width, height, xoff, yoff, self.palette, dedupe)
         else:
             raise TypeError("image mode must be 'P', 'RGB', or 'RGBA'")
 
-    def from_file(self, filename, translate=False):
-        """Load graphic from an image file."""
+    def from_file(self, filename, translate=False, dedupe=False, dither=None):
+        """Load graphic from an image file. See from_Image for the
+        parameters; returns the number of bytes saved by deduplication
+        (0 for .lmp files, which are loaded as they are)."""
         if filename[-4:].lower() == '.lmp':
             self.data = readfile(filename)
+            return 0
         else:
             im = Image.open(filename)
-            self.from_Image(im, translate)
+            return self.from_Image(im, translate=translate, dedupe=dedupe, dither=dither)
 
     def to_file(self, filename, mode='P'):
         """Save the graphic to an image file.
@@ -607,18 +792,24 @@ class Graphic(Lump):
             else:
                 im.save(filename, "PNG")
 
+    def remap(self, table):
+        """Remap (in-place) the colors of the graphic through a 256-byte
+        translation table (see bytes.translate).
+
+        Only the pixels inside posts are translated; the column structure
+        is left as it is, so the graphic is not decoded or re-encoded."""
+        data = bytearray(self.data)
+        for pointer in set(self.get_pointers()):
+            while pointer < len(data) and data[pointer] != 0xff:
+                start = pointer + 3
+                stop = start + data[pointer + 1]
+                data[start:stop] = data[start:stop].translate(table)
+                pointer = stop + 1
+        self.data = bytes(data)
+
     def translate(self, pal):
         """Translate (in-place) the graphic to another palette."""
-        lexicon = [pal.match(self.palette.colors[i]) for i in range(256)]
-        lexicon[self.palette.tran_index] = pal.tran_index
-        if isinstance(self, Flat):
-            self.data = bytes([lexicon[b] for b in self.data])
-        else:
-            raw = self.to_raw()
-            self.load_raw(bytes([lexicon[b] for b in raw]),
-                self.width, self.height,
-                self.x_offset, self.y_offset)
-
+        self.remap(pal.match_many(self.palette.colors))
 
 class Flat(Graphic):
     """Subclass of Graphic, for flat graphics."""
@@ -640,5 +831,16 @@ class Flat(Graphic):
     def load_raw(self, data, *unused):
         self.data = data
 
+    def remap(self, table):
+        """Remap (in-place) the colors of the flat through a 256-byte
+        translation table (see bytes.translate)."""
+        self.data = self.data.translate(table)
+
+    def translate(self, pal):
+        """Translate (in-place) the flat to another palette."""
+        lexicon = bytearray(pal.match_many(self.palette.colors))
+        lexicon[self.palette.tran_index] = pal.tran_index
+        self.remap(bytes(lexicon))
+
     def to_raw(self):
         return self.data
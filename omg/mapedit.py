@@ -1,7 +1,14 @@
+from struct import pack_into, unpack_from
 from omg.util import *
 from omg.lump import *
 from omg.wad import NameGroup
 
+# NumPy is optional; it is only used for StructArray.column.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 import omg.lineinfo as lineinfo
 import omg.thinginfo as thinginfo
 
@@ -232,6 +239,207 @@ class SubSector(WADStruct):
         ("seg_a",   ctypes.c_uint16)
     ]
 
+# struct formats for the ctypes field types used by map structures
+_field_formats = {
+    ctypes.c_byte: 'b', ctypes.c_ubyte: 'B',
+    ctypes.c_int16: 'h', ctypes.c_uint16: 'H',
+    ctypes.c_int32: 'i', ctypes.c_uint32: 'I',
+}
+
+def _struct_fields(class_):
+    """Yield (name, offset, format, bits) for each field of a WADStruct
+    class, where 'format' is a struct format ('8s' for names) and 'bits'
+    is None or a (shift, mask) pair for the flags of a WADFlags field."""
+    for field in class_._fields_:
+        name, ftype = field[:2]
+        offset = getattr(class_, name).offset
+        if issubclass(ftype, ctypes.Union):
+            # WADFlags: the whole field, then each flag
+            yield name, offset, '<H', None
+            shift = 0
+            for flag, flagtype, size in ftype.Flags._fields_:
+                yield flag, offset, '<H', (shift, (1 << size) - 1)
+                shift += size
+        elif issubclass(ftype, ctypes.Array):
+            yield name, offset, '%ds' % ctypes.sizeof(ftype), None
+        else:
+            yield name, offset, '<' + _field_formats[ftype], None
+
+def _record_property(offset, fmt, bits):
+    if fmt[-1] == 's':
+        size = int(fmt[:-1])
+        def get(self):
+            start = self._start() + offset
+            return safe_name(zstrip(bytes(self.array.data[start : start+size])))
+        def set(self, value):
+            if isinstance(value, str):
+                value = safe_name(value).encode('ascii')
+            # like ctypes, add a terminating null byte if there's room,
+            # but leave the rest of the field alone
+            value = value[:size] + b'\0'
+            start = self._start() + offset
+            self.array.data[start : start + min(len(value), size)] = value[:size]
+    elif bits:
+        shift, mask = bits
+        def get(self):
+            return (unpack_from(fmt, self.array.data, self._start()+offset)[0] >> shift) & mask
+        def set(self, value):
+            data = self.array.data
+            start = self._start() + offset
+            old = unpack_from(fmt, data, start)[0] & ~(mask << shift)
+            pack_into(fmt, data, start, old | ((int(value) & mask) << shift))
+    else:
+        def get(self):
+            return unpack_from(fmt, self.array.data, self._start()+offset)[0]
+        def set(self, value):
+            pack_into(fmt, self.array.data, self._start()+offset, value)
+    return property(get, set)
+
+class Record:
+    """A proxy for one record of a StructArray, with the same attributes
+    as the structure it stores (e.g. v.x for a Vertex). Reading and
+    writing them accesses the array's data directly.
+
+    A record refers to a position in its array, so after records are
+    inserted or deleted before it, it refers to another one. copy()
+    returns a standalone instance of the structure instead."""
+    __slots__ = ('array', 'index', 'offset')
+
+    def __init__(self, array, index):
+        self.array = array
+        self.index = index
+        self.offset = index * array.size
+
+    def _start(self):
+        """Return the offset of the record, checking that the array
+        still contains it."""
+        if self.offset + self.array.size > len(self.array.data):
+            raise IndexError("Record refers to a deleted StructArray index")
+        return self.offset
+
+    def __bytes__(self):
+        start = self._start()
+        return bytes(self.array.data[start : start + self.array.size])
+
+    pack = __bytes__
+
+    def __copy__(self):
+        return self.array.class_.from_buffer_copy(self.array.data, self._start())
+
+    def __eq__(self, other):
+        if isinstance(other, Record):
+            return self.array is other.array and self.index == other.index
+        return NotImplemented
+
+    def __hash__(self):
+        return hash((id(self.array), self.index))
+
+_record_classes = {}
+
+def record_class(class_):
+    """Return the Record subclass used for a WADStruct class."""
+    if class_ not in _record_classes:
+        props = dict((name, _record_property(offset, fmt, bits)) \
+            for name, offset, fmt, bits in _struct_fields(class_))
+        props['__slots__'] = ()
+        _record_classes[class_] = type(class_.__name__ + 'Record', (Record,), props)
+    return _record_classes[class_]
+
+class StructArray:
+    """A list-like array of WADStruct records (e.g. the vertexes of a
+    map) stored back to back in a single bytearray, in the same format
+    as in the map lumps.
+
+    Indexing returns Record proxies (see Record); assigning or appending
+    takes structure instances or records. If NumPy is available, column
+    returns a field of all records as an array."""
+
+    def __init__(self, class_, data=b''):
+        self.class_ = class_
+        self.size = ctypes.sizeof(class_)
+        self.record = record_class(class_)
+        self.data = bytearray(data[:len(data) - len(data) % self.size])
+
+    def __len__(self):
+        return len(self.data) // self.size
+
+    def _index(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError("StructArray index out of range")
+        return i
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            return [self.record(self, j) for j in range(*i.indices(len(self)))]
+        return self.record(self, self._index(i))
+
+    def __setitem__(self, i, obj):
+        i = self._index(i)
+        self.data[i*self.size : (i+1)*self.size] = bytes(obj)
+
+    def __delitem__(self, i):
+        if isinstance(i, slice):
+            for j in sorted(range(*i.indices(len(self))), reverse=True):
+                del self[j]
+            return
+        i = self._index(i)
+        del self.data[i*self.size : (i+1)*self.size]
+
+    def __iter__(self):
+        # check the length on each step, so that records can be removed
+        # while iterating, as with a list
+        i = 0
+        while i < len(self):
+            yield self.record(self, i)
+            i += 1
+
+    def append(self, obj):
+        self.data += bytes(obj)
+
+    def extend(self, objs):
+        self.data += bytes().join(bytes(obj) for obj in objs)
+
+    def insert(self, i, obj):
+        i = min(max(i + len(self) if i < 0 else i, 0), len(self))
+        self.data[i*self.size : i*self.size] = bytes(obj)
+
+    def index(self, obj):
+        """Return the index of a record, or of the first record with the
+        same contents as a structure instance."""
+        if isinstance(obj, Record) and obj.array is self:
+            return obj.index
+        packed = bytes(obj)
+        for i in range(len(self)):
+            if self.data[i*self.size : (i+1)*self.size] == packed:
+                return i
+        raise ValueError("record not in StructArray")
+
+    def remove(self, obj):
+        del self[self.index(obj)]
+
+    def tobytes(self):
+        """Return the records as lump data."""
+        return bytes(self.data)
+
+    def column(self, name):
+        """Return a field of all records as a NumPy array sharing memory
+        with the StructArray, e.g. things.column('x'). Flags can only be
+        accessed as a whole ('flags'). The array must be deleted before
+        records are added or removed."""
+        if np is None:
+            raise ImportError("StructArray.column requires NumPy")
+        names, formats, offsets = [], [], []
+        for field, offset, fmt, bits in _struct_fields(self.class_):
+            if bits is None:
+                names.append(field)
+                formats.append('S' + fmt[:-1] if fmt[-1] == 's' else fmt)
+                offsets.append(offset)
+        dtype = np.dtype({'names': names, 'formats': formats, 'offsets': offsets,
+            'itemsize': self.size})
+        return np.frombuffer(self.data, dtype)[name]
+
 class MapEditor:
     """Doom map editor.
 
@@ -282,8 +490,15 @@ class MapEditor:
             self.reject   = Lump("")
 
     def _unpack_lump(self, class_, data):
+        # Copy the whole lump into a ctypes array at once; its elements
+        # are structure instances sharing the array's memory.
         s = ctypes.sizeof(class_)
-        return [class_(bytes=data[i:i+s]) for i in range(0,len(data),s)]
+        n = -(-len(data) // s)
+        data = bytes(data) + bytes(n*s - len(data))
+        return list((class_ * n).from_buffer_copy(data))
+
+    def _pack_lump(self, items):
+        return bytes().join(map(bytes, items))
 
     def from_lumps(self, lumpgroup):
         """Load entries from a lump group."""
@@ -347,14 +562,14 @@ class MapEditor:
         m = NameGroup()
 
         m["_HEADER_"] = self.header
-        m["VERTEXES"] = Lump(join([x.pack() for x in self.vertexes]))
-        m["THINGS"  ] = Lump(join([x.pack() for x in self.things  ]))
-        m["LINEDEFS"] = Lump(join([x.pack() for x in self.linedefs]))
-        m["SIDEDEFS"] = Lump(join([x.pack() for x in self.sidedefs]))
-        m["SECTORS" ] = Lump(join([x.pack() for x in self.sectors ]))
-        m["NODES"]    = Lump(join([x.pack() for x in self.nodes   ]))
-        m["SEGS"]     = Lump(join([x.pack() for x in self.segs    ]))
-        m["SSECTORS"] = Lump(join([x.pack() for x in self.ssectors]))
+        m["VERTEXES"] = Lump(self._pack_lump(self.vertexes))
+        m["THINGS"  ] = Lump(self._pack_lump(self.things  ))
+        m["LINEDEFS"] = Lump(self._pack_lump(self.linedefs))
+        m["SIDEDEFS"] = Lump(self._pack_lump(self.sidedefs))
+        m["SECTORS" ] = Lump(self._pack_lump(self.sectors ))
+        m["NODES"]    = Lump(self._pack_lump(self.nodes   ))
+        m["SEGS"]     = Lump(self._pack_lump(self.segs    ))
+        m["SSECTORS"] = Lump(self._pack_lump(self.ssectors))
         m["BLOCKMAP"] = self.blockmap
         m["REJECT"]   = self.reject
 
@@ -386,7 +601,6 @@ class MapEditor:
         for i in range(len(vertexes)):
             side = copy(sidedef)
             side.sector = len(self.sectors)-1
-            self.sidedefs.append(side)
 
             #check if the new line is being written over an existing
             #and merge them if so.
@@ -402,11 +616,14 @@ class MapEditor:
                     self.sidedefs[lc.front].tx_up = side.tx_mid
                     side.tx_mid = "-"
                     self.sidedefs[lc.front].tx_mid = "-"
-                    lc.back = len(self.sidedefs)-1
+                    lc.back = firsts+i
                     match_existing = True
                     lc.two_sided = True
                     lc.impassable = False
                     break
+            # append the sidedef only now, since it may have been
+            # changed above (and some editors store copies)
+            self.sidedefs.append(side)
             if (match_existing == False):
                 self.linedefs.append(new_linedef)
 
@@ -503,3 +720,41 @@ class MapEditor:
             z.x += offset[0]
             z.y += offset[1]
             self.things.append(z)
+
+
+class ColumnarMapEditor(MapEditor):
+    """A MapEditor storing the map structures in StructArrays instead of
+    lists of structure instances: each lump is loaded with one copy and
+    saved with one bytes() call, and large maps take much less memory.
+
+    Records are accessed through proxies with the same attributes as
+    the structures (see Record), so most code written for MapEditor
+    works unchanged. Note that a record is a reference to a position in
+    its array; use copy() to get a standalone structure instance. With
+    NumPy, whole fields can be processed at once through
+    StructArray.column, e.g.:
+
+        x = editor.vertexes.column('x')
+        x *= -1
+    """
+
+    def __init__(self, from_lumps=None):
+        """Create new, optionally from a lump group."""
+        MapEditor.__init__(self, from_lumps)
+        if from_lumps is None:
+            self.vertexes = StructArray(Vertex)
+            self.sidedefs = StructArray(Sidedef)
+            self.linedefs = StructArray(self.Linedef)
+            self.sectors  = StructArray(Sector)
+            self.things   = StructArray(self.Thing)
+            self.segs     = StructArray(Seg)
+            self.ssectors = StructArray(SubSector)
+            self.nodes    = StructArray(Node)
+
+    def _unpack_lump(self, class_, data):
+        return StructArray(class_, data)
+
+    def _pack_lump(self, items):
+        if isinstance(items, StructArray):
+            return items.tobytes()
+        return MapEditor._pack_lump(self, items)
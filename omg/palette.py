@@ -1,6 +1,51 @@
+import os, hashlib
+from operator import add
 from struct   import pack, unpack
 from omg.util import *
 
+# NumPy is optional; it is used to speed up lookup tables and bulk
+# operations, and it is required for generating palettes.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# PIL is only needed for loading image files when generating palettes.
+try:
+    from PIL import Image
+except:
+    pass
+
+# sRGB component (0-255) to linear light, used for CIELAB conversions
+srgb_linear = [c/12.92 if c <= 0.04045 else ((c + 0.055) / 1.055) ** 2.4 \
+    for c in [i/255 for i in range(256)]]
+
+def _lab_f(t):
+    return t ** (1/3) if t > 216/24389 else (24389/27 * t + 16) / 116
+
+def rgb_to_lab(color):
+    """Convert an (r,g,b) tuple to CIELAB (D65 white point)."""
+    r, g, b = [srgb_linear[c] for c in color]
+    x = _lab_f((0.4124564*r + 0.3575761*g + 0.1804375*b) / 0.95047)
+    y = _lab_f( 0.2126729*r + 0.7151522*g + 0.0721750*b)
+    z = _lab_f((0.0193339*r + 0.1191920*g + 0.9503041*b) / 1.08883)
+    return (116*y - 16, 500*(x - y), 200*(y - z))
+
+def _lab_array(colors):
+    """Vectorized rgb_to_lab for an (N, 3) integer array."""
+    linear = np.array(srgb_linear)[colors]
+    xyz = linear @ np.array([[0.4124564, 0.2126729, 0.0193339],
+                             [0.3575761, 0.7151522, 0.1191920],
+                             [0.1804375, 0.0721750, 0.9503041]])
+    xyz /= (0.95047, 1.0, 1.08883)
+    f = np.where(xyz > 216/24389, np.cbrt(xyz), (24389/27 * xyz + 16) / 116)
+    return np.stack([116*f[:,1] - 16, 500*(f[:,0] - f[:,1]), 200*(f[:,1] - f[:,2])], 1)
+
+# Origin and number of cells (per L*, a* and b*) of the grid dividing
+# CIELAB space into 8x8x8 cells, used for exact lookups with the 'lab'
+# metric (see Palette.build_grid); it covers all sRGB colors.
+lab_grid = ((0.0, -88.0, -108.0), (13, 24, 26))
+
 class Palette:
 
     """Used for storing a list of colors and doing things with them
@@ -22,19 +67,46 @@ class Palette:
 
     The following fields are intended for internal use:
 
-        .memo         Table for RGB lookup memoization
+        .memo         Table for RGB lookup memoization (an OrderedDict,
+                      least recently used colors first)
+        .memo_size    Maximum number of colors memoized (None: no limit)
+        .memo_hits    Number of lookups found in the memo
+        .memo_misses  Number of lookups not found in the memo
+        .memo_evictions  Number of colors evicted from the memo
         .grays        List of indices of colors with zero saturation
         .bright_lut   Brightness LUT, used internally to speed up
                       lookups (when not memoized).
+        .grid         Grid of candidate colors, used for exact lookups
+        .lab          Palette's colors in CIELAB, for the 'lab' metric
+        .cube         Dense RGB lookup cube, if built (see build_cube)
     """
 
-    def __init__(self, colors=None, tran_index=None, tran_color=None):
+    def __init__(self, colors=None, tran_index=None, tran_color=None, engine='bucket', metric='rgb', memo_size=None):
         """Creates a new Palette object. The 'colors' argument may be
         either a list of (r,g,b) tuples or an RGBRGBRGB... string/bytes.
         'tran_index' specifies the index in the palette where the
         transparent color should be placed. Note that this is only used
         when saving images, and thus doesn't affect color lookups.
-        'tran_color' is the color to use for transparency."""
+        'tran_color' is the color to use for transparency.
+
+        'engine' selects how colors are looked up when not memoized:
+        'bucket' only compares colors of similar brightness (see
+        build_lut), which is fast but approximate, while 'exact' always
+        finds the closest color (see match_exact).
+
+        'metric' selects how the distance between colors is measured:
+        'rgb' is plain Euclidean distance in RGB, 'redmean' weights the
+        channels depending on the mean red level of the two colors, and
+        'lab' is the distance in CIELAB (CIE76). The perceptual metrics
+        are slow to compute, so with them colors are always matched
+        exactly, through a grid of candidates (see build_grid) if NumPy
+        is available. 'engine' only applies to the 'rgb' metric. A
+        lookup cube can also be built (see build_cube); this takes a
+        second or two with the perceptual metrics, so it is never built
+        automatically.
+
+        'memo_size' limits the number of colors kept in the memo; when it
+        is full, the least recently used colors are evicted."""
 
         colors = colors or default_colors
         tran_index = tran_index or default_tran_index
@@ -61,8 +133,19 @@ class Palette:
         # conversions significantly, in particular when converting
         # lots of graphics in one session. See docstring for build_lut
         # below for description of what bright_lut does.
-        self.memo = {}
+        if engine not in ('bucket', 'exact'):
+            raise ValueError("engine must be 'bucket' or 'exact'")
+        self.engine = engine
+        if metric not in ('rgb', 'redmean', 'lab'):
+            raise ValueError("metric must be 'rgb', 'redmean' or 'lab'")
+        self.metric = metric
+        self.lab = None
+        self.memo_size = memo_size
+        self.memo_hits = self.memo_misses = self.memo_evictions = 0
         self.bright_lut = []
+        self.grid = {}
+        self.grid_bounds = []
+        self.reset_cube()
         self.reset_memo()
 
     def make_bytes(self):
@@ -74,6 +157,11 @@ class Palette:
             pack('BBB', *self.tran_color) + \
             self.bytes[(self.tran_index+1)*3:]
 
+    def channels(self):
+        """Returns the red, green and blue components of the palette
+        as three 256-byte translation tables (see bytes.translate)."""
+        return self.bytes[0::3], self.bytes[1::3], self.bytes[2::3]
+
     def make_grays(self):
         """Create 'grays' table containing the indices of all grays
         in the current set of colors."""
@@ -82,10 +170,61 @@ class Palette:
 
     def reset_memo(self):
         """Clear the memo table (but (re)add the palette's colors)"""
-        self.memo = {}
+        self.memo = OrderedDict()
         for i in range(len(self.colors)):
             if i != self.tran_index:
                 self.memo[self.colors[i]] = i
+        self.trim_memo()
+
+    def memoize(self, color, index):
+        """Add a color to the memo table, evicting the least recently
+        used colors if it is full."""
+        self.memo[color] = index
+        if self.memo_size is not None and len(self.memo) > self.memo_size:
+            self.trim_memo()
+
+    def trim_memo(self):
+        """Evict the least recently used colors until the memo table
+        holds no more than memo_size colors."""
+        if self.memo_size is None:
+            return
+        while len(self.memo) > self.memo_size:
+            self.memo.popitem(last=False)
+            self.memo_evictions += 1
+
+    def memo_info(self):
+        """Return a dict of memo statistics: 'hits', 'misses',
+        'evictions', 'size' (current number of colors) and 'maxsize'."""
+        return {'hits': self.memo_hits, 'misses': self.memo_misses,
+            'evictions': self.memo_evictions, 'size': len(self.memo),
+            'maxsize': self.memo_size}
+
+    def memo_key(self):
+        """Return a digest identifying the palette's colors and lookup
+        settings, i.e. everything the memoized results depend on."""
+        settings = "%s %s" % (self.engine, self.metric)
+        return hashlib.sha1(self.bytes + settings.encode('ascii')).digest()
+
+    def memo_snapshot(self):
+        """Return the memo table as a bytes object, which can be passed
+        to memo_restore (possibly in another process) to warm up the memo
+        of a palette with the same colors and settings. Colors are saved
+        from least to most recently used."""
+        return self.memo_key() + bytes().join(
+            [pack('BBBB', r, g, b, i) for (r, g, b), i in self.memo.items()])
+
+    def memo_restore(self, data):
+        """Add the colors from a snapshot made by memo_snapshot to the
+        memo table. Raises ValueError if the snapshot was made for a
+        different palette or with different settings."""
+        key = self.memo_key()
+        if data[:len(key)] != key:
+            raise ValueError("memo snapshot doesn't match this palette")
+        for pos in range(len(key), len(data), 4):
+            r, g, b, i = data[pos:pos+4]
+            self.memo[(r, g, b)] = i
+            self.memo.move_to_end((r, g, b))
+        self.trim_memo()
 
     def build_lut(self, distance=16):
         """Build 256-entry LUT for looking up colors in the palette
@@ -122,13 +261,343 @@ class Palette:
                 candidates.append(best_i)
             self.bright_lut.append(candidates)
 
+    def digest(self):
+        """Returns a hex digest identifying the palette's colors
+        (used as a key when caching tables built from them)."""
+        return hashlib.sha1(self.bytes).hexdigest()
+
+    def reset_cube(self):
+        """Discard the lookup cube."""
+        self.cube = None
+        self.cube_bits = 0
+        self.cube_ambiguous = None
+
+    def build_cube(self, bits=6, exact=False, cache_dir=None):
+        """Build a dense lookup cube holding the closest palette index
+        for each color quantized to 'bits' bits per channel (1-8), and
+        use it for lookups from then on. At 6 bits, the cube takes up
+        256 KB. Lookups then are a simple table index, but colors are
+        matched as if they had been quantized.
+
+        If 'exact' is true, the cells where quantizing could change
+        the result are also flagged, and colors falling in them are
+        matched exactly (and memoized) instead.
+
+        Building the cube requires NumPy. If 'cache_dir' is given, the
+        cube is saved there and loaded again if a cube for the same
+        palette colors and settings already exists."""
+        assert 1 <= bits <= 8
+        path = None
+        if cache_dir:
+            metric = "" if self.metric == 'rgb' else self.metric + "-"
+            path = os.path.join(cache_dir, "cube-%s-%s%d%s.bin" % \
+                (self.digest(), metric, bits, "x" if exact else ""))
+        if path and os.path.exists(path):
+            data = readfile(path)
+        else:
+            data = self._make_cube(bits, exact)
+            if path:
+                writefile(path, data)
+
+        size = 1 << (3*bits)
+        self.cube = data[:size]
+        self.cube_bits = bits
+        self.cube_ambiguous = data[size:] if exact else None
+
+    def _make_cube(self, bits, exact):
+        if np is None:
+            raise ImportError("building a lookup cube requires NumPy")
+        if self.metric != 'rgb':
+            return self._make_metric_cube(bits, exact)
+        shift = 8 - bits
+        width = 1 << shift
+        levels = np.arange(1 << bits, dtype=np.int32) << shift
+        pal = np.array(self.colors, dtype=np.int32)
+        # The squared distance is a sum of one term per channel, so the
+        # distances from the center of every cell to every palette color
+        # can be added together from three small tables, one red plane
+        # at a time.
+        center = levels + (width >> 1)
+        terms = [(center[:,None] - pal[None,:,k]) ** 2 for k in range(3)]
+        planes = []
+        for r in range(len(levels)):
+            dist = terms[0][r][None,None,:] + terms[1][:,None,:] + terms[2][None,:,:]
+            # argmin picks the lowest index in case of ties, just like
+            # an exact search
+            planes.append(dist.argmin(2).astype(np.uint8).ravel())
+        cube = np.concatenate(planes)
+        if not exact:
+            return cube.tobytes()
+        if shift == 0:
+            return cube.tobytes() + bytes(len(cube))
+
+        # For every other color j, the difference between the squared
+        # distances to the best color and to j is linear in the color
+        # being matched, so its maximum over a cell is found at one of
+        # its corners. If that maximum is below zero (or zero, for colors
+        # j that lose ties) the best color is the closest one for the
+        # whole cell. Otherwise, the cell is flagged as ambiguous.
+        g, b = [x.ravel() for x in np.meshgrid(levels, levels, indexing='ij')]
+        pal_sq = (pal*pal).sum(1)
+        index = np.arange(len(pal))[None,:]
+        ambiguous = []
+        for r, best in zip(levels, planes):
+            best = best.astype(np.intp)
+            best_color = pal[best]
+            worst = pal_sq[best][:,None] - pal_sq[None,:]
+            for k, lo in enumerate((r, g[:,None], b[:,None])):
+                diff = pal[None,:,k] - best_color[:,k,None]
+                worst += 2 * (diff * lo + (width - 1) * np.maximum(diff, 0))
+            unsafe = np.where(index < best[:,None], worst >= 0, worst > 0)
+            unsafe[np.arange(len(best)), best] = False
+            ambiguous.append(unsafe.any(1).astype(np.uint8))
+        return cube.tobytes() + np.concatenate(ambiguous).tobytes()
+
+    def _make_metric_cube(self, bits, exact):
+        # The perceptual metrics aren't sums of per-channel terms, so
+        # the distances are computed for a red plane of cells at a time.
+        shift = 8 - bits
+        width = 1 << shift
+        levels = np.arange(1 << bits, dtype=np.int64) << shift
+        g, b = [x.ravel() for x in np.meshgrid(levels, levels, indexing='ij')]
+        def nearest(reds, greens, blues):
+            planes = []
+            for r in reds:
+                points = np.stack([np.full(len(greens), r), greens, blues], 1)
+                planes.append(self._distance_matrix(points).argmin(1).astype(np.uint8))
+            return np.concatenate(planes)
+        center = width >> 1
+        cube = nearest(levels + center, g + center, b + center)
+        if not exact:
+            return cube.tobytes()
+        if shift == 0:
+            return cube.tobytes() + bytes(len(cube))
+
+        # There is no cheap bound on the distances over a cell here, so
+        # a cell is flagged as ambiguous unless the colors at all of its
+        # corners match the same color as its center. (Unlike with the
+        # 'rgb' metric, this can miss cells with a small enclave of some
+        # other color.)
+        corners = np.append(levels, 255)
+        cg, cb = [x.ravel() for x in np.meshgrid(corners, corners, indexing='ij')]
+        n = len(corners)
+        lattice = nearest(corners, cg, cb).reshape(n, n, n)
+        cube3 = cube.reshape(n-1, n-1, n-1)
+        ambiguous = np.zeros(cube3.shape, dtype=bool)
+        for dr in (0, 1):
+            for dg in (0, 1):
+                for db in (0, 1):
+                    ambiguous |= lattice[dr:n-1+dr, dg:n-1+dg, db:n-1+db] != cube3
+        return cube.tobytes() + ambiguous.astype(np.uint8).tobytes()
+
+    def grid_cell(self, cell):
+        """Return the candidates for exact lookups in a cell of the grid
+        used by match_exact, as a list of (index, r, g, b) tuples.
+
+        The grid divides the RGB cube into 16x16x16 cells. A color is
+        a candidate for a cell if its smallest possible distance to the
+        cell is no larger than the largest possible distance from the
+        cell to some other color; any other color is always further
+        away than that one, wherever the matched color is in the cell.
+
+        With NumPy, the candidates of all cells are computed at once the
+        first time any cell is used (see build_grid); otherwise, they
+        are computed the first time each cell is used."""
+        if cell in self.grid:
+            return self.grid[cell]
+        if np is not None:
+            self.build_grid()
+            return self.grid[cell]
+        if not self.grid_bounds:
+            # Per channel and grid level, the smallest and largest
+            # possible distance (squared) of each color's component
+            # to that level's range of values
+            for k in range(3):
+                near, far = [], []
+                for lo in range(0, 256, 16):
+                    hi = lo + 15
+                    near.append([(lo - c[k])**2 if c[k] < lo else \
+                        (c[k] - hi)**2 if c[k] > hi else 0 for c in self.colors])
+                    far.append([max(c[k] - lo, hi - c[k])**2 for c in self.colors])
+                self.grid_bounds.append((near, far))
+        (rn, rf), (gn, gf), (bn, bf) = self.grid_bounds
+        r, g, b = cell >> 8, (cell >> 4) & 15, cell & 15
+        near = map(add, map(add, rn[r], gn[g]), bn[b])
+        bound = min(map(add, map(add, rf[r], gf[g]), bf[b]))
+        candidates = [(i,) + tuple(self.colors[i]) \
+            for i, d in enumerate(near) if d <= bound]
+        self.grid[cell] = candidates
+        return candidates
+
+    def build_grid(self):
+        """Compute the candidates of all cells of the grid used by
+        match_exact (see grid_cell) at once. Requires NumPy.
+
+        With the 'redmean' metric, the bounds take the range of channel
+        weights over each cell into account. With the 'lab' metric, the
+        grid divides CIELAB space instead, into cells of 8x8x8 units
+        (see lab_grid), and the candidates hold CIELAB coordinates."""
+        if self.metric == 'lab':
+            if self.lab is None:
+                self.lab = [rgb_to_lab(c) for c in self.colors]
+            rows = [(i,) + tuple(c) for i, c in enumerate(self.lab)]
+            values = np.array(self.lab).T
+            origin, shape = lab_grid
+            lo = [(origin[k] + 8*np.arange(shape[k]))[:,None] for k in range(3)]
+            hi = [l + 8 for l in lo]
+        else:
+            rows = [(i,) + tuple(c) for i, c in enumerate(self.colors)]
+            values = np.array(self.colors, dtype=np.int64).T
+            lo = [np.arange(0, 256, 16)[:,None]] * 3
+            hi = [l + 15 for l in lo]
+        # Per grid level, channel and color, the smallest and largest
+        # possible distance (squared) of the color's component to the
+        # level's range of values
+        near, far = [], []
+        for k in range(3):
+            c = values[k][None]
+            near.append(np.where(c < lo[k], (lo[k] - c)**2,
+                np.where(c > hi[k], (c - hi[k])**2, 0)))
+            far.append(np.maximum(c - lo[k], hi[k] - c)**2)
+        def cells(r, g, b):
+            return r[:,None,None] + g[None,:,None] + b[None,None,:]
+        if self.metric == 'redmean':
+            # the red mean, and so the weights of the red and blue
+            # channels, only depend on the red level
+            rmin = (lo[0] + values[0][None]) >> 1
+            rmax = (hi[0] + values[0][None]) >> 1
+            zero = np.zeros_like(near[2])
+            lower = cells(((512 + rmin)*near[0]) >> 8, 4*near[1], zero) + \
+                (((767 - rmax)[:,None,None] * near[2][None,None]) >> 8)
+            upper = cells(((512 + rmax)*far[0]) >> 8, 4*far[1], zero) + \
+                (((767 - rmin)[:,None,None] * far[2][None,None]) >> 8)
+            bound = upper.min(-1)
+        else:
+            lower = cells(*near)
+            bound = cells(*far).min(-1)
+            if self.metric == 'lab':
+                # allow for rounding errors in the CIELAB conversions
+                bound += 1e-6
+        size = bound.size
+        cell, index = np.nonzero((lower <= bound[...,None]).reshape(size, -1))
+        split = np.searchsorted(cell, np.arange(1, size))
+        self.grid = dict((n, [rows[i] for i in found.tolist()]) \
+            for n, found in enumerate(np.split(index, split)))
+
+    def match_exact(self, color):
+        """Find the closest match in the palette for a color. Unlike
+        the brightness buckets, this always finds the closest color; in
+        case of ties, the lowest index is returned."""
+        if self.metric != 'rgb':
+            if np is not None:
+                return self._match_grid_metric(color)
+            return self._match_metric(color)
+        ar, ag, ab = color
+        best_dist = 262144
+        best_i = 0
+        cell = ((ar >> 4) << 8) | ((ag >> 4) << 4) | (ab >> 4)
+        candidates = self.grid.get(cell) or self.grid_cell(cell)
+        for i, br, bg, bb in candidates:
+            dr = ar-br
+            dg = ag-bg
+            db = ab-bb
+            dist = dr*dr + dg*dg + db*db
+            if dist < best_dist:
+                if dist == 0:
+                    return i
+                best_dist = dist
+                best_i = i
+        return best_i
+
+    def _match_grid_metric(self, color):
+        """match_exact for the perceptual metrics, scanning the
+        candidates of a cell of the grid (see build_grid)."""
+        if not self.grid:
+            self.build_grid()
+        best_dist = None
+        best_i = 0
+        if self.metric == 'lab':
+            al, aa, ab = rgb_to_lab(color)
+            (ol, oa, ob), (nl, na, nb) = lab_grid
+            cell = (min(max(int((al - ol) // 8), 0), nl - 1) * na + \
+                    min(max(int((aa - oa) // 8), 0), na - 1)) * nb + \
+                    min(max(int((ab - ob) // 8), 0), nb - 1)
+            for i, bl, ba, bb in self.grid[cell]:
+                dl = al-bl
+                da = aa-ba
+                db = ab-bb
+                dist = dl*dl + da*da + db*db
+                if best_dist is None or dist < best_dist:
+                    best_dist = dist
+                    best_i = i
+            return best_i
+        ar, ag, ab = color
+        cell = ((ar >> 4) << 8) | ((ag >> 4) << 4) | (ab >> 4)
+        for i, br, bg, bb in self.grid[cell]:
+            rmean = (ar + br) >> 1
+            dr = ar-br
+            dg = ag-bg
+            db = ab-bb
+            dist = (((512 + rmean)*dr*dr) >> 8) + 4*dg*dg + (((767 - rmean)*db*db) >> 8)
+            if best_dist is None or dist < best_dist:
+                best_dist = dist
+                best_i = i
+        return best_i
+
+    def _match_metric(self, color):
+        """match_exact for the perceptual metrics, without NumPy."""
+        if self.metric == 'lab':
+            if self.lab is None:
+                self.lab = [rgb_to_lab(c) for c in self.colors]
+            colors = self.lab
+            al, aa, ab = rgb_to_lab(color)
+        else:
+            colors = self.colors
+            ar, ag, ab = color
+        best_dist = None
+        best_i = 0
+        for i, c in enumerate(colors):
+            if self.metric == 'lab':
+                dl = al-c[0]
+                da = aa-c[1]
+                db = ab-c[2]
+                dist = dl*dl + da*da + db*db
+            else:
+                rmean = (ar + c[0]) >> 1
+                dr = ar-c[0]
+                dg = ag-c[1]
+                db = ab-c[2]
+                dist = (((512 + rmean)*dr*dr) >> 8) + 4*dg*dg + (((767 - rmean)*db*db) >> 8)
+            if best_dist is None or dist < best_dist:
+                best_dist = dist
+                best_i = i
+        return best_i
+
     def match(self, color):
         """Find the closest match in the palette for a color.
         Takes an (r,g,b) tuple as argument and returns a palette index."""
         if color == self.tran_color:
             return self.tran_index
         if color in self.memo:
+            self.memo_hits += 1
+            if self.memo_size is not None:
+                self.memo.move_to_end(color)
             return self.memo[color]
+        self.memo_misses += 1
+        if self.cube is not None:
+            bits = self.cube_bits
+            shift = 8 - bits
+            ar, ag, ab = color
+            cell = (((ar >> shift) << bits | (ag >> shift)) << bits) | (ab >> shift)
+            if self.cube_ambiguous is None or not self.cube_ambiguous[cell]:
+                return self.cube[cell]
+            best_i = self.match_exact(color)
+            self.memoize(color, best_i)
+            return best_i
+        if self.engine == 'exact' or self.metric != 'rgb':
+            best_i = self.match_exact(color)
+            self.memoize(color, best_i)
+            return best_i
         if len(self.bright_lut) == 0:
             self.build_lut()
         best_dist = 262144
@@ -146,9 +615,197 @@ class Palette:
                     return i
                 best_dist = dist
                 best_i = i
-        self.memo[color] = best_i
+        self.memoize(color, best_i)
         return best_i
 
+    def match_many(self, colors):
+        """Find the closest matches in the palette for many colors at
+        once. 'colors' may be a list of (r,g,b) tuples, a bytes-like
+        object (rgbrgbrgb...) or a NumPy array of shape (N, 3).
+
+        Returns the palette indices as a bytes object (which may be
+        passed to numpy.frombuffer to get an array). The results are
+        the same as calling match for each color, and they are also
+        memoized the same way; with NumPy, the distances of all
+        colors not found in the memo are computed in bulk."""
+        if isinstance(colors, (bytes, bytearray, memoryview)):
+            colors = memoryview(colors).cast('B')
+            if np is None:
+                colors = list(zip(colors[0::3], colors[1::3], colors[2::3]))
+            else:
+                colors = np.frombuffer(colors, dtype=np.uint8)
+        if np is None:
+            lexicon = dict((c, self.match(c)) for c in set(map(tuple, colors)))
+            return bytes(map(lexicon.__getitem__, map(tuple, colors)))
+
+        colors = np.asarray(colors, dtype=np.int64).reshape(-1, 3)
+        packed = (colors[:,0] << 16) | (colors[:,1] << 8) | colors[:,2]
+        unique, inverse = np.unique(packed, return_inverse=True)
+        unique = np.stack([unique >> 16, (unique >> 8) & 255, unique & 255], 1)
+
+        # colors that match() would not look up by distance
+        result = np.zeros(len(unique), dtype=np.uint8)
+        lookup = np.ones(len(unique), dtype=bool)
+        for n, color in enumerate(map(tuple, unique.tolist())):
+            if color == tuple(self.tran_color):
+                result[n] = self.tran_index
+            elif color in self.memo:
+                result[n] = self.memo[color]
+                if self.memo_size is not None:
+                    self.memo.move_to_end(color)
+            else:
+                continue
+            lookup[n] = False
+        self.memo_hits += int(len(unique) - lookup.sum())
+        self.memo_misses += int(lookup.sum())
+
+        remaining = unique[lookup]
+        memoize = np.ones(len(remaining), dtype=bool)
+        if self.cube is not None:
+            bits = self.cube_bits
+            shift = 8 - bits
+            cell = (((remaining[:,0] >> shift) << bits | (remaining[:,1] >> shift)) << bits) \
+                | (remaining[:,2] >> shift)
+            found = np.frombuffer(self.cube, dtype=np.uint8)[cell]
+            if self.cube_ambiguous is None:
+                memoize[:] = False
+            else:
+                memoize = np.frombuffer(self.cube_ambiguous, dtype=np.uint8)[cell] != 0
+            found[memoize] = self._match_exact_many(remaining[memoize])
+        elif self.engine == 'exact' or self.metric != 'rgb':
+            found = self._match_exact_many(remaining)
+        else:
+            found = self._match_bucket_many(remaining)
+        result[lookup] = found
+
+        for color, index in zip(map(tuple, remaining[memoize].tolist()), found[memoize].tolist()):
+            self.memo[color] = index
+        self.trim_memo()
+        return result[inverse.ravel()].tobytes()
+
+    def dither(self, pixels, width, method='ordered', strength=32):
+        """Match the colors of an image to the palette with dithering.
+        'pixels' holds the image's colors as a bytes-like object
+        (rgbrgbrgb...), 'width' is the width of the image. Returns the
+        palette indices as a bytes object, like match_many.
+
+        'method' is either 'ordered', which adds an 8x8 Bayer threshold
+        pattern of up to +/- strength/2 to the colors before matching
+        them all at once (this requires NumPy), or 'floyd-steinberg',
+        which matches the pixels one at a time, spreading the error of
+        each match to the pixels right and below it.
+
+        Pixels of the transparent color are never dithered."""
+        if method == 'ordered':
+            return self._dither_ordered(pixels, width, strength)
+        if method == 'floyd-steinberg':
+            return self._dither_fs(pixels, width)
+        raise ValueError("method must be 'ordered' or 'floyd-steinberg'")
+
+    def _dither_ordered(self, pixels, width, strength):
+        if np is None:
+            raise ImportError("ordered dithering requires NumPy")
+        colors = np.frombuffer(bytes(pixels), dtype=np.uint8).reshape(-1, width, 3)
+        height = len(colors)
+        threshold = bayer_matrix(8)
+        threshold = (threshold - threshold.mean()) * (strength / 64)
+        threshold = np.tile(threshold, ((height + 7) // 8, (width + 7) // 8))
+        noisy = np.clip(colors + np.rint(threshold[:height,:width,None]), 0, 255).astype(np.uint8)
+        # leave transparent pixels alone, and don't make new ones
+        tran = np.array(self.tran_color, dtype=np.uint8)
+        keep = (colors == tran).all(2) | (noisy == tran).all(2)
+        noisy[keep] = colors[keep]
+        return self.match_many(noisy.reshape(-1, 3))
+
+    def _dither_fs(self, pixels, width):
+        pixels = memoryview(pixels).cast('B')
+        height = len(pixels) // (3*width)
+        out = bytearray(width*height)
+        colors = self.colors
+        match = self.match
+        tran_color = tuple(self.tran_color)
+        # Errors (times 16) spread to the current and the next row, with
+        # room for one pixel on either side
+        current = [0] * (3*width + 6)
+        for y in range(height):
+            below = [0] * (3*width + 6)
+            row = pixels[3*width*y:3*width*(y+1)]
+            for x in range(width):
+                i = 3*x
+                color = (row[i], row[i+1], row[i+2])
+                if color == tran_color:
+                    out[width*y + x] = self.tran_index
+                    continue
+                e = i + 3
+                r = min(max(row[i]   + ((current[e]   + 8) >> 4), 0), 255)
+                g = min(max(row[i+1] + ((current[e+1] + 8) >> 4), 0), 255)
+                b = min(max(row[i+2] + ((current[e+2] + 8) >> 4), 0), 255)
+                if (r, g, b) != tran_color:
+                    color = (r, g, b)
+                index = match(color)
+                out[width*y + x] = index
+                pr, pg, pb = colors[index]
+                for k, err in ((0, r - pr), (1, g - pg), (2, b - pb)):
+                    current[e+3+k] += 7*err
+                    below[e-3+k] += 3*err
+                    below[e+k] += 5*err
+                    below[e+3+k] += err
+            current = below
+        return bytes(out)
+
+    def _distance_matrix(self, colors):
+        """Return the distances (squared, using the palette's metric)
+        from an (N, 3) integer array of colors to each palette color."""
+        if self.metric == 'lab':
+            if self.lab is None:
+                self.lab = [rgb_to_lab(c) for c in self.colors]
+            lab = _lab_array(colors)
+            pal = np.array(self.lab)
+            dist = np.zeros((len(colors), len(pal)))
+            for k in range(3):
+                dist += (lab[:,k,None] - pal[None,:,k]) ** 2
+            return dist
+        pal = np.array(self.colors, dtype=np.int32)
+        colors = colors.astype(np.int32)
+        if self.metric == 'redmean':
+            diff = [(colors[:,k,None] - pal[None,:,k]) ** 2 for k in range(3)]
+            rmean = (colors[:,0,None] + pal[None,:,0]) >> 1
+            return (((512 + rmean) * diff[0]) >> 8) + 4 * diff[1] + \
+                (((767 - rmean) * diff[2]) >> 8)
+        dist = np.zeros((len(colors), len(pal)), dtype=np.int32)
+        for k in range(3):
+            dist += (colors[:,k,None] - pal[None,:,k]) ** 2
+        return dist
+
+    def _distances(self, colors, chunk):
+        """Yield (start, distances) for chunks of an (N, 3) array of
+        colors, with one column per palette color."""
+        for start in range(0, len(colors), chunk):
+            yield start, self._distance_matrix(colors[start:start+chunk])
+
+    def _match_exact_many(self, colors, chunk=4096):
+        """Vectorized match_exact (argmin picks the lowest index on ties)."""
+        found = np.zeros(len(colors), dtype=np.uint8)
+        for start, dist in self._distances(colors, chunk):
+            found[start:start+len(dist)] = dist.argmin(1)
+        return found
+
+    def _match_bucket_many(self, colors, chunk=4096):
+        """Vectorized equivalent of the brightness bucket scan in match.
+        Colors outside a bucket are excluded, and ties are broken by the
+        order in which the scan visits the candidates."""
+        if len(self.bright_lut) == 0:
+            self.build_lut()
+        rank = np.full((256, len(self.colors)), 1 << 40, dtype=np.int64)
+        for level, candidates in enumerate(self.bright_lut):
+            rank[level, candidates] = np.arange(len(candidates))
+        levels = colors.sum(1) // 3
+        found = np.zeros(len(colors), dtype=np.uint8)
+        for start, dist in self._distances(colors, chunk):
+            key = dist.astype(np.int64) * 512 + rank[levels[start:start+len(dist)]]
+            found[start:start+len(dist)] = key.argmin(1)
+        return found
+
     def blend(self, color, intensity=0.5):
         """Blend the entire palette against a color (given as an RGB triple).
         Intensity must be a floating-point number in the range 0-1."""
@@ -157,15 +814,183 @@ class Palette:
         ng = color[1] * intensity
         nb = color[2] * intensity
         remain = 1.0 - intensity
-        for i in range(len(self.colors)):
-            ar, ag, ab = self.colors[i]
-            self.colors[i] = (int(ar*remain + nr),
-                              int(ag*remain + ng),
-                              int(ab*remain + nb))
+        self.set_colors([(int(ar*remain + nr), int(ag*remain + ng), int(ab*remain + nb)) \
+            for ar, ag, ab in self.colors])
+
+    def set_colors(self, colors):
+        """Replace the colors of the palette (given as a list of (r,g,b)
+        tuples or an RGBRGBRGB... bytes object) and discard everything
+        derived from them (memo, lookup tables and cube)."""
+        if isinstance(colors, (bytes, bytearray)):
+            colors = [unpack('BBB', colors[i:i+3]) for i in range(0,768,3)]
+        self.colors = list(colors)
         self.make_bytes()
         self.make_grays()
         self.reset_memo()
+        self.reset_cube()
         self.bright_lut = []
+        self.grid = {}
+        self.grid_bounds = []
+        self.lab = None
+
+def bayer_matrix(size):
+    """Return a size x size Bayer threshold matrix (size being a power
+    of two) as a NumPy array holding the values 0 to size*size-1."""
+    matrix = np.zeros((1, 1), dtype=np.int32)
+    while len(matrix) < size:
+        matrix = np.block([[4*matrix, 4*matrix + 2], [4*matrix + 3, 4*matrix + 1]])
+    return matrix
+
+class PaletteBuilder:
+    """Generates a palette that fits a set of images.
+
+    Images are added one at a time, and only a histogram of their
+    colors is kept: colors are grouped in bins (of 'bits' bits per
+    channel), and for each bin the number of pixels and the sums of
+    their components are recorded, so the average color of each bin
+    is exact. Pixels of the transparency color are ignored, as are
+    fully transparent pixels of RGBA images. If 'sample' is given, at
+    most that many randomly chosen pixels of each image are counted.
+
+    Requires NumPy."""
+
+    def __init__(self, bits=5, sample=None, seed=0, tran_color=None):
+        if np is None:
+            raise ImportError("generating palettes requires NumPy")
+        assert 1 <= bits <= 8
+        self.bits = bits
+        self.sample = sample
+        self.rng = np.random.default_rng(seed)
+        self.tran_color = tran_color or default_tran_color
+        self.counts = np.zeros(1 << (3*bits), dtype=np.int64)
+        self.sums = np.zeros((1 << (3*bits), 3), dtype=np.int64)
+
+    def add_pixels(self, pixels):
+        """Add colors given as a bytes-like object (rgbrgbrgb...) or a
+        NumPy array of shape (N, 3)."""
+        if isinstance(pixels, (bytes, bytearray, memoryview)):
+            pixels = np.frombuffer(pixels, dtype=np.uint8)
+        colors = np.asarray(pixels).reshape(-1, 3)
+        if self.sample and len(colors) > self.sample:
+            colors = colors[self.rng.choice(len(colors), self.sample, replace=False)]
+        colors = colors[(colors != self.tran_color).any(1)].astype(np.int64)
+        bits, shift = self.bits, 8 - self.bits
+        cell = (((colors[:,0] >> shift) << bits | (colors[:,1] >> shift)) << bits) \
+            | (colors[:,2] >> shift)
+        size = len(self.counts)
+        self.counts += np.bincount(cell, minlength=size)
+        for k in range(3):
+            self.sums[:,k] += np.bincount(cell, colors[:,k], size).astype(np.int64)
+
+    def add_image(self, im):
+        """Add the pixels of a PIL Image instance (or an image file,
+        given its path)."""
+        if isinstance(im, str):
+            im = Image.open(im)
+        if 'A' in im.getbands() or 'transparency' in im.info:
+            pixels = np.frombuffer(im.convert('RGBA').tobytes(), dtype=np.uint8).reshape(-1, 4)
+            self.add_pixels(pixels[pixels[:,3] > 0, :3])
+        else:
+            self.add_pixels(im.convert('RGB').tobytes())
+
+    def points(self):
+        """Return the average colors of the bins in use, as an (N, 3)
+        array, and the number of pixels in each."""
+        used = self.counts.nonzero()[0]
+        weights = self.counts[used]
+        return self.sums[used] / weights[:,None], weights
+
+    def median_cut(self, count):
+        """Return up to 'count' colors (as an array) found by median
+        cut: the set of colors is repeatedly split in two, at the
+        weighted median of its widest channel, starting with the set
+        with the most pixels times its widest range. If no colors were
+        added, the result is empty."""
+        points, weights = self.points()
+        if not len(points):
+            return np.zeros((0, 3))
+        def score(box):
+            if len(box) < 2:
+                return -1
+            extent = points[box].max(0) - points[box].min(0)
+            return extent.max() * weights[box].sum()
+        boxes = [np.arange(len(points))]
+        scores = [score(boxes[0])]
+        while len(boxes) < count:
+            i = int(np.argmax(scores))
+            if scores[i] <= 0:
+                break
+            box = boxes[i]
+            channel = (points[box].max(0) - points[box].min(0)).argmax()
+            box = box[np.argsort(points[box, channel], kind='stable')]
+            total = np.cumsum(weights[box])
+            cut = min(max(int(np.searchsorted(total, total[-1] / 2)) + 1, 1), len(box) - 1)
+            boxes[i:i+1] = [box[:cut], box[cut:]]
+            scores[i:i+1] = [score(box[:cut]), score(box[cut:])]
+        return np.array([np.average(points[box], 0, weights[box]) for box in boxes])
+
+    def kmeans(self, count, iterations=10, chunk=4096):
+        """Return up to 'count' colors found by k-means clustering,
+        starting from the result of median_cut."""
+        points, weights = self.points()
+        centers = self.median_cut(count).astype(np.float32)
+        values = points.astype(np.float32)
+        nearest = None
+        for n in range(iterations):
+            found = np.zeros(len(points), dtype=np.intp)
+            for start in range(0, len(points), chunk):
+                part = values[start:start+chunk]
+                dist = np.zeros((len(part), len(centers)), dtype=np.float32)
+                for k in range(3):
+                    dist += (part[:,k,None] - centers[None,:,k]) ** 2
+                found[start:start+chunk] = dist.argmin(1)
+            if nearest is not None and (found == nearest).all():
+                break
+            nearest = found
+            total = np.bincount(nearest, weights, len(centers))
+            used = total > 0
+            for k in range(3):
+                sums = np.bincount(nearest, weights * points[:,k], len(centers))
+                centers[used,k] = sums[used] / total[used]
+        return centers
+
+    def to_palette(self, method='median-cut', reserved=None, tran_index=None,
+        tran_color=None, iterations=10):
+        """Generate a Palette from the colors added so far, with either
+        the 'median-cut' or the 'kmeans' method.
+
+        'reserved' is a dict mapping palette indices to the (r, g, b)
+        colors they must keep; the generated colors fill the other
+        indices, sorted by brightness. By default, only the index for
+        transparency is reserved (holding the transparency color). To
+        get a PLAYPAL, pass the result to Playpal."""
+        tran_index = tran_index or default_tran_index
+        tran_color = tran_color or self.tran_color
+        if reserved is None:
+            reserved = {tran_index: tran_color}
+        count = 256 - len(reserved)
+        if method == 'median-cut':
+            colors = self.median_cut(count)
+        elif method == 'kmeans':
+            colors = self.kmeans(count, iterations)
+        else:
+            raise ValueError("method must be 'median-cut' or 'kmeans'")
+        colors = np.clip(np.rint(colors), 0, 255).astype(int).reshape(-1, 3)
+        colors = sorted(map(tuple, colors.tolist()), key=sum)
+        colors += [(0, 0, 0)] * (count - len(colors))
+        generated = iter(colors)
+        return Palette([tuple(reserved[i]) if i in reserved else next(generated) \
+            for i in range(256)], tran_index, tran_color)
+
+def generate(images, method='median-cut', reserved=None, tran_index=None,
+    tran_color=None, sample=None, bits=5, iterations=10, seed=0):
+    """Generate a Palette fitting an iterable of images (PIL Image
+    instances or file names), which are read one at a time. See
+    PaletteBuilder for details on the arguments."""
+    builder = PaletteBuilder(bits, sample, seed, tran_color)
+    for im in images:
+        builder.add_image(im)
+    return builder.to_palette(method, reserved, tran_index, tran_color, iterations)
 
 # Colors of the Doom palette, used by default
 default_colors = b"\
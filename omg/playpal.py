@@ -2,6 +2,43 @@ from omg.lump import Lump
 from omg.util import *
 import omg.palette
 
+# NumPy is optional; it only speeds up blending the palettes.
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+class Palettes:
+    """A list-like view of the 14 palettes of a Playpal, as Palette
+    instances. A palette is only created when it is first used; storing
+    a Palette replaces the colors of that palette."""
+
+    def __init__(self, playpal):
+        self.playpal = playpal
+
+    def __len__(self):
+        return 14
+
+    def __getitem__(self, n):
+        if isinstance(n, slice):
+            return [self.playpal.get_palette(i) for i in range(*n.indices(14))]
+        if n < 0:
+            n += 14
+        if not 0 <= n < 14:
+            raise IndexError("palette index out of range")
+        return self.playpal.get_palette(n)
+
+    def __setitem__(self, n, palette):
+        if n < 0:
+            n += 14
+        if not 0 <= n < 14:
+            raise IndexError("palette index out of range")
+        self.playpal.set_palette(n, palette)
+
+    def __iter__(self):
+        for n in range(14):
+            yield self.playpal.get_palette(n)
+
 class Playpal:
     """An editor for Doom's PLAYPAL lump. The PLAYPAL lump contains 14
     palettes: the game's base palette, the palettes used when the
@@ -9,19 +46,90 @@ class Playpal:
     when the player picks up an item, and the palette used when the
     player is wearing the radiation suit.
 
-    The palettes are located in a member list called 'palettes'. Each
-    palette is a Palette instance."""
+    The colors of the palettes are stored together in a bytearray
+    called 'data' (14*256 rgb triplets; see also the array method).
+    The list-like member 'palettes' holds them as Palette instances;
+    these are only created when they are first used. Changes made to
+    them are written to 'data', and changes made to 'data' are copied
+    to them, when the lump is saved or blended (or when calling sync)."""
 
     def __init__(self, source=None):
         """Construct a new EditPlaypal object. Source may be a PLAYPAL
         lump or a Palette instance. If a Palette instance, all 14
         palettes are set to copies of it. If no source is specified,
         the default palette is used."""
+        self.data = bytearray(14*768)
+        self.settings = {}
+        self.palettes = Palettes(self)
+        self._reset()
         if isinstance(source, Lump):
             self.from_lump(source)
         else:
             self.set_base(source)
 
+    def _reset(self):
+        # The Palette instances created so far, and the colors they had
+        # when they were last synced with 'data'
+        self._palettes = [None] * 14
+        self._synced = [None] * 14
+
+    def get_palette(self, n):
+        """Return palette number n as a Palette instance."""
+        if self._palettes[n] is None:
+            colors = bytes(self.data[n*768:(n+1)*768])
+            self._palettes[n] = omg.palette.Palette(colors, **self.settings)
+            self._synced[n] = colors
+        return self._palettes[n]
+
+    def set_palette(self, n, palette):
+        """Replace palette number n by a Palette instance."""
+        self.data[n*768:(n+1)*768] = palette.bytes
+        self._palettes[n] = palette
+        self._synced[n] = palette.bytes
+
+    def sync(self):
+        """Synchronize 'data' with the Palette instances created so far:
+        the colors of palettes changed since the last sync are written
+        to 'data', and palettes whose colors were changed in 'data' are
+        updated."""
+        for n, palette in enumerate(self._palettes):
+            if palette is None:
+                continue
+            if palette.bytes != self._synced[n]:
+                self.data[n*768:(n+1)*768] = palette.bytes
+            else:
+                colors = bytes(self.data[n*768:(n+1)*768])
+                if colors != palette.bytes:
+                    palette.set_colors(colors)
+            self._synced[n] = palette.bytes
+
+    def array(self):
+        """Return the palettes as a NumPy array of shape (14, 256, 3),
+        sharing its memory with 'data'. Requires NumPy."""
+        if np is None:
+            raise ImportError("Playpal.array requires NumPy")
+        self.sync()
+        return np.frombuffer(self.data, dtype=np.uint8).reshape(14, 256, 3)
+
+    def blend(self, numbers, color, intensities):
+        """Blend a number of palettes against a color (given as an RGB
+        triple), each with its own intensity (in the range 0-1). The
+        result is the same as calling Palette.blend for each of them."""
+        assert all(0.0 <= i <= 1.0 for i in intensities)
+        if np is not None:
+            pals = self.array()
+            intensity = np.array(intensities)[:,None,None]
+            blended = pals[numbers] * (1.0 - intensity) + np.array(color) * intensity
+            pals[numbers] = blended.astype(np.uint8)
+        else:
+            self.sync()
+            for n, intensity in zip(numbers, intensities):
+                remain = 1.0 - intensity
+                add = [c * intensity for c in color] * 256
+                self.data[n*768:(n+1)*768] = bytes([int(c*remain + a) \
+                    for c, a in zip(self.data[n*768:(n+1)*768], add)])
+        self.sync()
+
     def build_defaults(self):
         """Build all 13 extra palettes, using default values (red for
         pain, yellow for item pickups, green for the radiation suit).
@@ -33,32 +141,36 @@ class Playpal:
 
     def build_suit (self, color=(0,255,0), intensity=0.2):
         """Set the color and intensity for the radiation suit palette."""
-        self.palettes[13].blend(color, intensity)
+        self.blend([13], color, [intensity])
 
     def build_pain (self, color=(255,0,0), minintensity=0.1, maxintensity=0.8):
         """Set the color and intensities for the player-in-pain (also
         used by the berserk powerup) palettes."""
         step = (maxintensity - minintensity) / 8.0
-        for i in range(8):
-            self.palettes[i+1].blend(color, step*i + minintensity)
+        self.blend(list(range(1, 9)), color, [step*i + minintensity for i in range(8)])
 
     def build_item (self, color=(255,255,64), minintensity=0.1, maxintensity=0.3):
         """Set color and intensity for the item pick-up palettes."""
         step = (maxintensity - minintensity) / 3.0
-        for i in range(3):
-            self.palettes[i+10].blend(color, step * i + minintensity)
+        self.blend(list(range(10, 13)), color, [step*i + minintensity for i in range(3)])
 
     def from_lump(self, lump):
         """Load data from a PLAYPAL lump."""
-        self.palettes = [omg.palette.Palette(lump.data[i*768:(i+1)*768], 0, 0)
-            for i in range(14)]
+        self.data[:] = lump.data[:14*768]
+        self.settings = {}
+        self._reset()
 
     def to_lump(self):
         """Compile to a Doom-ready PLAYPAL Lump."""
-        return Lump(join([p.bytes for p in self.palettes]))
+        self.sync()
+        return Lump(bytes(self.data))
 
     def set_base(self, palette=None):
         """Set all palettes to copies of a given Palette object. If the
         palette parameter is not provided, the default palette is used."""
         palette = palette or omg.palette.default
-        self.palettes = [deepcopy(palette) for i in range(14)]
+        self.data[:] = palette.bytes * 14
+        self.settings = {'tran_index': palette.tran_index,
+            'tran_color': palette.tran_color, 'engine': palette.engine,
+            'metric': palette.metric, 'memo_size': palette.memo_size}
+        self._reset()
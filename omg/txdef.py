@@ -1,4 +1,8 @@
-from omg.lump import Lump
+import os
+from concurrent.futures import ProcessPoolExecutor
+from struct import iter_unpack, pack_into, unpack_from
+import omg.palette
+from omg.lump import Lump, Graphic, rgba_from_indices
 from omg.util import *
 from omg.wad  import TxdefGroup
 
@@ -33,6 +37,16 @@ class PatchDef(WADStruct):
         self.id = -1
         super().__init__(*args, **kwargs)
 
+    # The patch name is not part of the structure (it is looked up in
+    # PNAMES), but is normalized the same way as the name fields.
+    @property
+    def name(self):
+        return self._name
+
+    @name.setter
+    def name(self, value):
+        self._name = safe_name(zstrip(encode_name(value)))
+
 # TODO: integrate with textures lump group instead?
 
 class Textures(OrderedDict):
@@ -44,8 +58,12 @@ class Textures(OrderedDict):
 
             Textures(texture1, pnames)
             Textures(txdefs)
-        """
+
+        The entries of the loaded PNAMES lump are kept (as 8-byte
+        strings) in .pnames, so that to_lumps can write them back in
+        their original order."""
         OrderedDict.__init__(self)
+        self.pnames = []
         if len(args):
             self.from_lumps(*args)
 
@@ -63,59 +81,78 @@ class Textures(OrderedDict):
 
     def _from_lumps(self, texture1, pnames):
         # Unpack PNAMES
-        numdefs = unpack16(pnames.data[0:2])
-        pnames = [zstrip(pnames.data[ptr:ptr+8]) \
-            for ptr in range(4, 8*numdefs+4, 8)]
+        data = pnames.data
+        numdefs = unpack_from('<i', data)[0]
+        self.pnames = [entry for entry, in iter_unpack('8s', data[4:4+8*numdefs])]
+        pnames = [zstrip(entry) for entry in self.pnames]
 
         # Unpack TEXTURE1
         data = texture1.data
-        numtextures = unpack('<i', data[0:4])[0]
-        pointers = unpack('<%ii'%numtextures, data[4:4+numtextures*4])
+        numtextures = unpack_from('<i', data)[0]
+        pointers = unpack_from('<%ii'%numtextures, data, 4)
         for ptr in pointers:
-            texture = TextureDef(bytes=data[ptr:ptr+22])
-            for pptr in range(ptr+22, ptr+22+10*texture.npatches, 10):
-                x, y, idn = unpack('<hhh', data[pptr:pptr+6])
-                texture.patches.append(PatchDef(x, y, name=pnames[idn]))
+            # from_buffer_copy skips __init__, so the attributes that
+            # aren't part of the structures are set here
+            texture = TextureDef.from_buffer_copy(data, ptr)
+            start = ptr + 22
+            end = start + 10*texture.npatches
+            patches = []
+            for pptr, (idn,) in zip(range(start, end, 10), iter_unpack('<4xh4x', data[start:end])):
+                patch = PatchDef.from_buffer_copy(data, pptr)
+                patch.name = pnames[idn]
+                patches.append(patch)
+            texture.patches = patches
             self[texture.name] = texture
 
-    def to_lumps(self):
-        """Returns two lumps TEXTURE1, PNAMES."""
+    def to_lumps(self, sort=False):
+        """Returns two lumps TEXTURE1, PNAMES. Textures are written in
+        the order they were added, or sorted by name if `sort` is true.
+
+        Patch names loaded from a PNAMES lump keep their positions
+        (whether they are used or not), and names not found there are
+        added at the end, so loading and saving unmodified lumps gives
+        identical output."""
         textures = self.items()
-        textures.sort()
+        if sort:
+            textures.sort(key=lambda item: item[0])
 
-        pnames = []
-        # Count unique patch names, assign correct num to each patch
-        used_pnames = {}
+        # Assign the correct PNAMES index to each patch
+        entries = list(self.pnames)
+        names = [safe_name(zstrip(entry)) for entry in entries]
+        index = {}
+        for i, name in enumerate(names):
+            index.setdefault(name, i)
         for name, data in textures:
             for p in data.patches:
-                if p.name not in used_pnames:
-                    used_pnames[p.name] = len(used_pnames)
-                p.id = used_pnames[p.name]
-        pnmap = sorted([(i, name) for (name, i) in used_pnames.items()])
-        pnames = pack32(len(pnmap)) + \
-            bytes().join(zpad(safe_name(name)) for i, name in pnmap)
-
-        texture1 = []
-        pointers = []
-        ptr = 4 + len(self)*4
-        for name, data in textures:
+                name = p.name
+                if 0 <= p.id < len(names) and names[p.id] == name:
+                    continue
+                if name not in index:
+                    index[name] = len(entries)
+                    entries.append(zpad(name))
+                    names.append(name)
+                p.id = index[name]
+        pnames = bytearray(4 + 8*len(entries))
+        pack_into('<i', pnames, 0, len(entries))
+        pnames[4:] = bytes().join(entries)
+
+        # Pack TEXTURE1 into a preallocated buffer: the texture count,
+        # one pointer per texture, then each texture and its patches
+        ptr = 4 + len(textures)*4
+        size = ptr + sum(22 + 10*len(data.patches) for name, data in textures)
+        texture1 = bytearray(size)
+        pack_into('<i', texture1, 0, len(textures))
+        for n, (name, data) in enumerate(textures):
             data.npatches = len(data.patches)
-            texture1.append(data.pack())
-            texture1.append(bytes().join(p.pack() for p in data.patches))
-            pointers.append(ptr)
-            ptr += 22 + data.npatches*10
-
-        a = pack32(len(textures))
-        #print "a", len(a)
-        b = bytes().join([pack32(p) for p in pointers])
-        #print "b", len(b)
-        #print "texture1", type(texture1), len(texture1)
-        #print texture1
-        c = bytes().join(texture1)
-        texture1 = bytes().join([a, b, c])
+            pack_into('<i', texture1, 4 + n*4, ptr)
+            texture1[ptr:ptr+22] = bytes(data)
+            ptr += 22
+            for p in data.patches:
+                texture1[ptr:ptr+10] = bytes(p)
+                ptr += 10
 
         g = TxdefGroup('txdefs', Lump, ['TEXTURE?', 'PNAMES'])
-        g['TEXTURE1'], g['PNAMES'] = Lump(texture1), Lump(pnames)
+        g['TEXTURE1'], g['PNAMES'] = Lump(bytes(texture1)), Lump(bytes(pnames))
         return g
 
     def simple(self, name, plump):
@@ -124,3 +161,119 @@ class Textures(OrderedDict):
         self[name].patches.append(PatchDef())
         self[name].patches[0].name = self[name].name = name
         self[name].width, self[name].height = plump.dimensions
+
+
+class Compositor:
+    """Renders texture definitions to 8-bit or RGBA pixel buffers by
+    drawing their patches.
+
+    Decoded patches are kept in an LRU cache (of `cache_size` patches),
+    so patches shared by several textures are only decoded once."""
+
+    def __init__(self, textures, patches, palette=None, cache_size=1024):
+        """Create a new compositor. `textures` is a Textures instance
+        (or any dict of TextureDef objects), and `patches` a lump group
+        or dict mapping patch names to lumps (e.g. wad.patches)."""
+        self.textures = textures
+        self.patches = patches
+        self.palette = palette or omg.palette.default
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+    def decode_patch(self, name):
+        """Returns the columns of a patch as lists of (y, pixels) posts
+        (see Graphic.get_posts), or None if there is no patch with that
+        name."""
+        if name in self.cache:
+            self.cache.move_to_end(name)
+            return self.cache[name]
+        if name not in self.patches:
+            return None
+
+        lump = self.patches[name]
+        columns = Graphic(getattr(lump, 'data', lump)).get_posts()
+
+        self.cache[name] = columns
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
+        return columns
+
+    def render(self, texture, mode='P'):
+        """Render a texture, given as a TextureDef or by name.
+
+        With mode 'P', returns the texture as raw 8-bit pixels, using
+        the palette's transparency index for areas not covered by any
+        patch. With mode 'RGBA', returns 32-bit pixels where those
+        areas are fully transparent. Missing patches are skipped."""
+        if isinstance(texture, str):
+            texture = self.textures[texture]
+        layout = [(p.x, p.y, p.name) for p in texture.patches]
+        return self._render(texture.width, texture.height, layout, mode)
+
+    def _render(self, width, height, layout, mode):
+        # Patches are drawn into column-major buffers, so that each
+        # post can be copied with a single slice assignment.
+        pixels = bytearray([self.palette.tran_index]) * (width*height)
+        mask = bytearray(width*height)
+        for px, py, name in layout:
+            columns = self.decode_patch(name)
+            if columns is None:
+                continue
+            for x in range(max(0, -px), min(len(columns), width - px)):
+                base = (px + x) * height
+                for y, post in columns[x]:
+                    y += py
+                    start = max(0, y)
+                    end = min(height, y + len(post))
+                    if start < end:
+                        pixels[base + start : base + end] = post[start - y : end - y]
+                        mask[base + start : base + end] = b'\xff' * (end - start)
+
+        output = bytearray(width*height)
+        alpha = bytearray(width*height)
+        for y in range(height):
+            output[y*width : (y+1)*width] = pixels[y::height]
+            alpha[y*width : (y+1)*width] = mask[y::height]
+        if mode == 'P':
+            return bytes(output)
+        elif mode == 'RGBA':
+            return rgba_from_indices(output, alpha, self.palette)
+        raise ValueError("mode must be 'P' or 'RGBA'")
+
+    def render_all(self, mode='P', workers=None):
+        """Render all textures, using a pool of worker processes.
+        `workers` is the number of processes to use; by default, one
+        per CPU is used. Returns an OrderedDict mapping texture names
+        to pixel buffers (see render)."""
+        jobs = [(name, t.width, t.height, [(p.x, p.y, p.name) for p in t.patches])
+            for name, t in self.textures.items()]
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(jobs) <= 1:
+            return OrderedDict((name, self._render(w, h, layout, mode)) \
+                for name, w, h, layout in jobs)
+
+        # Each worker gets its own compositor and patch cache; splitting
+        # the textures in contiguous chunks keeps shared patches together.
+        used = set(name for job in jobs for x, y, name in job[3])
+        patches = dict((name, getattr(self.patches[name], 'data', self.patches[name])) \
+            for name in used if name in self.patches)
+        palette = (self.palette.bytes, self.palette.tran_index, self.palette.tran_color)
+        size = -(-len(jobs) // workers)
+        chunks = [(jobs[i:i+size], mode) for i in range(0, len(jobs), size)]
+        output = OrderedDict()
+        with ProcessPoolExecutor(workers, initializer=_init_compositor,
+                initargs=(patches, palette, self.cache_size)) as pool:
+            for result in pool.map(_render_textures, chunks):
+                output.update(result)
+        return output
+
+# Compositor used by worker processes in Compositor.render_all
+_compositor = None
+
+def _init_compositor(patches, palette, cache_size):
+    global _compositor
+    _compositor = Compositor({}, patches, omg.palette.Palette(*palette), cache_size)
+
+def _render_textures(chunk):
+    jobs, mode = chunk
+    return [(name, _compositor._render(w, h, layout, mode)) for name, w, h, layout in jobs]
@@ -0,0 +1,163 @@
+"""
+    Usage -- indexes of the textures, flats, patches and thing types
+    used by the maps of a WAD, and pruning of unused lumps.
+"""
+
+import os
+from concurrent.futures import ProcessPoolExecutor
+from struct import iter_unpack
+from omg.util import *
+from omg.txdef import Textures
+from omg.udmf import UParser, udmf_types
+
+def _scan_map(job):
+    """Worker for UsageIndex.scan. Returns the map name and lists of
+    (resource, index) pairs for textures, flats and thing types."""
+    name, lumps = job
+    textures, flats, things = [], [], []
+    if 'TEXTMAP' in lumps:
+        toplevel, blocks = UParser(udmf_types).parse(lumps['TEXTMAP'])
+        for i, side in enumerate(blocks.get('sidedef', [])):
+            for field in ('texturetop', 'texturebottom', 'texturemiddle'):
+                if getattr(side, field):
+                    textures.append((getattr(side, field).upper(), i))
+        for i, sector in enumerate(blocks.get('sector', [])):
+            for field in ('texturefloor', 'textureceiling'):
+                if getattr(sector, field):
+                    flats.append((getattr(sector, field).upper(), i))
+        things = [(thing.type, i) for i, thing in enumerate(blocks.get('thing', []))]
+    else:
+        # Read the names straight from the lumps; names are normalized
+        # the same way as WADStruct does, once per distinct name.
+        names = {}
+        def fix(raw):
+            if raw not in names:
+                names[raw] = safe_name(zstrip(raw))
+            return names[raw]
+        for i, sides in enumerate(iter_unpack('<4x8s8s8s2x', lumps['SIDEDEFS'])):
+            textures.extend((fix(raw), i) for raw in sides)
+        for i, sector in enumerate(iter_unpack('<4x8s8s6x', lumps['SECTORS'])):
+            flats.extend((fix(raw), i) for raw in sector)
+        if 'BEHAVIOR' in lumps:
+            fmt = '<10xH8x'
+        else:
+            fmt = '<6xH2x'
+        things = [(type, i) for i, (type,) in enumerate(iter_unpack(fmt, lumps['THINGS']))]
+    textures = [(tex, i) for tex, i in textures if tex not in ('-', '')]
+    flats = [(flat, i) for flat, i in flats if flat not in ('-', '')]
+    return name, textures, flats, things
+
+
+class UsageIndex:
+    """Reverse indexes from resources to the objects using them.
+
+    Data members:
+        .textures   OrderedDict mapping texture names to lists of
+                    (map name, sidedef index) pairs
+        .flats      OrderedDict mapping flat names to lists of
+                    (map name, sector index) pairs
+        .things     OrderedDict mapping thing types to lists of
+                    (map name, thing index) pairs
+        .patches    OrderedDict mapping patch names to lists of the
+                    names of the textures using them
+        .txdefs     True if texture definitions have been indexed
+
+    Names are upper case. A sidedef or sector using the same name for
+    more than one texture is listed once per use."""
+
+    def __init__(self, wad=None, workers=None, txdefs=None):
+        """Create a new index, optionally scanning a WAD right away."""
+        self.textures = OrderedDict()
+        self.flats = OrderedDict()
+        self.things = OrderedDict()
+        self.patches = OrderedDict()
+        self.txdefs = False
+        if wad is not None:
+            self.scan(wad, workers, txdefs)
+
+    def scan(self, wad, workers=None, txdefs=None):
+        """Add the resources used by all maps (Doom, Hexen and UDMF) and
+        texture definitions of a WAD to the index.
+
+        The texture definitions are taken from `txdefs` (a txdefs lump
+        group, e.g. the one of the IWAD the WAD is used with) if given,
+        and otherwise from the WAD itself, if it has a PNAMES lump.
+
+        The maps are scanned directly from their lumps, using a pool of
+        worker processes; `workers` is the number of processes to use
+        (by default, one per CPU). With one worker, the maps are scanned
+        in the current process."""
+        jobs = []
+        for group, needed in ((wad.maps, ('SIDEDEFS', 'SECTORS', 'THINGS', 'BEHAVIOR')),
+                              (wad.udmfmaps, ('TEXTMAP',))):
+            for name, lumps in group.items():
+                jobs.append((name, dict((lump, lumps[lump].data) \
+                    for lump in needed if lump in lumps)))
+
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(jobs) <= 1:
+            results = list(map(_scan_map, jobs))
+        else:
+            with ProcessPoolExecutor(workers) as pool:
+                results = list(pool.map(_scan_map, jobs))
+
+        for name, textures, flats, things in results:
+            for index, users in ((self.textures, textures), (self.flats, flats),
+                                 (self.things, things)):
+                for resource, i in users:
+                    index.setdefault(resource, []).append((name, i))
+
+        if txdefs is None and 'PNAMES' in wad.txdefs:
+            txdefs = wad.txdefs
+        if txdefs is not None:
+            for name, texture in Textures(txdefs).items():
+                for patch in texture.patches:
+                    self.patches.setdefault(patch.name.upper(), []).append(name)
+            self.txdefs = True
+
+    def unused(self, wad, keep=(), sprites=None):
+        """Return the names of the lumps no map uses, as an OrderedDict
+        mapping group names ('flats', 'patches' and 'sprites') to lists.
+
+        Lumps matching any of the wildcard patterns in `keep` are always
+        kept; this is needed for resources used only by the engine, such
+        as the later frames of animated flats.
+
+        Flats and patches are only checked against the maps and texture
+        definitions indexed so far, not those of other WADs loaded with
+        this one. Patches are unused if no indexed texture definition
+        refers to them; if no texture definitions were indexed (e.g. for
+        a PWAD replacing patches of the IWAD's textures), patches are
+        never reported.
+
+        Since thing types don't name their sprites, sprites are only
+        considered if `sprites` is given, as a dict mapping thing types
+        to lists of 4-character sprite names; sprites of types not in
+        the index are then unused, while sprites not listed for any type
+        are kept."""
+        def unused_in(group, used):
+            return [name for name in group.keys() if name.upper() not in used \
+                and not any(wccmp(name, pattern) for pattern in keep)]
+
+        result = OrderedDict()
+        result['flats'] = unused_in(wad.flats, self.flats)
+        result['patches'] = []
+        if self.txdefs:
+            result['patches'] = unused_in(wad.patches, self.patches)
+        result['sprites'] = []
+        if sprites:
+            used = set(prefix.upper() for type in self.things for prefix in sprites.get(type, ()))
+            unused = set(prefix.upper() for prefixes in sprites.values() for prefix in prefixes)
+            unused -= used
+            result['sprites'] = [name for name in unused_in(wad.sprites, ()) \
+                if name[:4].upper() in unused]
+        return result
+
+    def prune(self, wad, keep=(), sprites=None):
+        """Remove the lumps found by unused (with the same arguments)
+        from the WAD. Returns what unused returned."""
+        result = self.unused(wad, keep, sprites)
+        for group, names in result.items():
+            for name in names:
+                del getattr(wad, group)[name]
+        return result
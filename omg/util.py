@@ -176,7 +176,50 @@ def WADFlags(flags):
 
     return FlagsUnion
 
-class WADStruct(ctypes.LittleEndianStructure):
+def encode_name(value):
+    """Return a name as it is stored in a WADStruct field. Strings are
+    converted to Doom-safe ASCII; byte strings are stored as they are."""
+    if type(value) == str:
+        return safe_name(value).encode('ascii')
+    return value
+
+class NameField:
+    """Descriptor for the c_char fields of a WADStruct, reading them as
+    Doom-safe strings. The decoded string is cached per instance until
+    the field is written through the descriptor."""
+
+    def __init__(self, field, name):
+        self.field = field
+        self.key = '_str_' + name
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            return self.field
+        cache = obj.__dict__
+        try:
+            return cache[self.key]
+        except KeyError:
+            value = cache[self.key] = safe_name(zstrip(self.field.__get__(obj)))
+            return value
+
+    def __set__(self, obj, value):
+        self.field.__set__(obj, encode_name(value))
+        obj.__dict__.pop(self.key, None)
+
+class WADStructType(type(ctypes.LittleEndianStructure)):
+    """Metaclass of WADStruct. Fields are read and written by the plain
+    ctypes descriptors, except for c_char fields which are wrapped in
+    NameField descriptors."""
+
+    def __init__(cls, name, bases, namespace):
+        super().__init__(name, bases, namespace)
+        for field in cls.__dict__.get('_fields_', ()):
+            fname, ftype = field[:2]
+            if ftype is ctypes.c_char or (issubclass(ftype, ctypes.Array) \
+                    and ftype._type_ is ctypes.c_char):
+                setattr(cls, fname, NameField(cls.__dict__[fname], fname))
+
+class WADStruct(ctypes.LittleEndianStructure, metaclass=WADStructType):
     """
     Class for creating WAD-related data structures.
 
@@ -193,6 +236,8 @@ class WADStruct(ctypes.LittleEndianStructure):
         if "bytes" in kwargs:
             buf = ctypes.create_string_buffer(kwargs["bytes"], ctypes.sizeof(self))
             ctypes.memmove(ctypes.byref(self), ctypes.byref(buf), len(buf))
+            for key in [key for key in self.__dict__ if key.startswith('_str_')]:
+                del self.__dict__[key]
         else:
             super().__init__(*args, **kwargs)
 
@@ -200,17 +245,6 @@ class WADStruct(ctypes.LittleEndianStructure):
         """Helper to maintain API backward compatibility. Returns bytes(self)."""
         return bytes(self)
 
-    def __getattribute__(self, name):
-        value = super().__getattribute__(name)
-        if type(value) == bytes:
-            return safe_name(zstrip(value))
-        return value
-
-    def __setattr__(self, name, value):
-        if type(value) == str:
-            value = safe_name(value).encode('ascii')
-        super().__setattr__(name, value)
-
     def __hash__(self):
         # needed because this is by default unhashable otherwise
         return hash(bytes(self))
@@ -1,9 +1,25 @@
 import os, glob
+from concurrent.futures import ProcessPoolExecutor
 import omg.palette
 from omg.lump  import *
 from omg.util import *
 from omg.wadio import WadIO
 
+# Palettes rebuilt by export worker processes, keyed by their contents
+_export_palettes = {}
+
+def _export_image(job):
+    """Worker for LumpGroup.export_images. Returns (name, path, error)."""
+    name, lumptype, data, palette, path, mode = job
+    try:
+        if palette not in _export_palettes:
+            _export_palettes[palette] = omg.palette.Palette(*palette)
+        lump = lumptype(data, palette=_export_palettes[palette])
+        lump.to_file(path, mode)
+        return name, path, None
+    except Exception as e:
+        return name, path, e
+
 class LumpGroup(OrderedDict):
     """A dict-like object for holding a group of lumps."""
 
@@ -46,6 +62,53 @@ class LumpGroup(OrderedDict):
         for m in self:
             wadio.insert(m, self[m].data, use_free=use_free)
 
+    def export_images(self, dirpath, format='png', mode='RGBA', workers=None):
+        """Save all graphics in the group to image files in a directory,
+        using a pool of worker processes.
+
+        `format` is the file extension to use, and `mode` is passed on
+        to Graphic.to_file. `workers` is the number of processes to
+        use; by default, one per CPU is used. With one worker, files
+        are written in the current process.
+
+        Errors are not raised; instead, a tuple (exported, failed) is
+        returned, where 'exported' is a list of the written file paths
+        and 'failed' is an OrderedDict mapping lump names to the
+        exceptions raised while exporting them. Items that aren't lumps
+        (such as maps) are reported as failed with a TypeError."""
+        if not os.path.isdir(dirpath):
+            os.makedirs(dirpath)
+        jobs = []
+        results = OrderedDict()
+        for name, lump in self.items():
+            path = os.path.join(dirpath, "%s.%s" % (fix_saving_name(name), format))
+            results[name] = (name, path, None)
+            if not isinstance(lump, Lump):
+                # e.g. the lump groups of wad.maps
+                results[name] = (name, path, TypeError("%s is not a lump" % name))
+                continue
+            palette = getattr(lump, 'palette', omg.palette.default)
+            jobs.append((name, type(lump), lump.data, (palette.bytes,
+                palette.tran_index, tuple(palette.tran_color)), path, mode))
+
+        workers = workers or os.cpu_count() or 1
+        if workers == 1 or len(jobs) <= 1:
+            done = list(map(_export_image, jobs))
+        else:
+            chunksize = max(1, len(jobs) // (workers * 4))
+            with ProcessPoolExecutor(workers) as pool:
+                done = list(pool.map(_export_image, jobs, chunksize=chunksize))
+        for result in done:
+            results[result[0]] = result
+
+        exported, failed = [], OrderedDict()
+        for name, path, error in results.values():
+            if error is None:
+                exported.append(path)
+            else:
+                failed[name] = error
+        return exported, failed
+
     def copy(self):
         """Creates a deep copy."""
         a = self.__class__(self._name, self.lumptype, self.config)